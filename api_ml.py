@@ -2,35 +2,43 @@
 
 import json
 import logging
-import requests
-import aiohttp
 import asyncio
+import copy
 import os
+import weakref
 from sqlalchemy.orm import Session
 
+from http_ml import fetch_api, fetch_api_async, fetch_api_condicional, guardar_validadores
+from cache_ml import clasificar, registrar
+from envios_ml import obtener_snapshot_envio, guardar_snapshot, invalidar_snapshot, snapshot_vigente
+
 from crud.utils import enriquecer_permalinks 
 from ws.items import obtener_todos_los_items, parsear_items
 from database.models import MLPedidoCache, WsItem, MLItem
+from database.connection import SessionLocal
 from datetime import datetime, timedelta, timezone
 from crud.pedidos import buscar_item_cache_por_sku, enriquecer_items_ws
-from auth_ml import get_ml_token
+from crud.ml_items import obtener_item_meta, precargar_items
+from crud.dashboard import actualizar_contadores_envio
+from auth_ml import get_ml_token, get_ml_token_async
 from typing import List, Dict
 
 
 
 # Configuración
-TOKEN_FILE    = "ml_token.json"
-CLIENT_ID     = "5569606371936049"
-CLIENT_SECRET = "wH7UDWXbA92DVlYa4P50cHBCLrEloMa0"
 API_BASE      = "https://api.mercadolibre.com"
 DEFAULT_IMG   = "https://via.placeholder.com/150"
 
+# Fan-out de órdenes por envío: máximo de llamadas concurrentes y timeout por llamada (s)
+ORDER_CONCURRENCY = int(os.getenv("ML_ORDER_CONCURRENCY", "4"))
+ORDER_TIMEOUT     = float(os.getenv("ML_ORDER_TIMEOUT", "15"))
+
 # Logger
 logging.basicConfig(level=logging.DEBUG, format="%(asctime)s [%(levelname)s] %(message)s")
 logger = logging.getLogger(__name__)
 
 
-def parse_order_data(order_data: dict, shipment_id: str = None) -> dict:
+async def parse_order_data(order_data: dict, shipment_id: str = None) -> dict:
     """
     De un JSON /orders/{order_id}, extraer:
       - titulo
@@ -53,6 +61,9 @@ def parse_order_data(order_data: dict, shipment_id: str = None) -> dict:
     raw_items = order_data.get("order_items", []) or order_data.get("items", [])
     items = []
 
+    # Todos los ítems de la orden en un solo multi-get (no-op si ya están en cache)
+    await precargar_items(_pares_items(order_data))
+
     for oi in raw_items:
         prod = oi.get("item", oi)
         titulo = prod.get("title", "Sin título")
@@ -71,23 +82,14 @@ def parse_order_data(order_data: dict, shipment_id: str = None) -> dict:
             or "Sin SKU"
         )
 
-        # Imágenes
-        imgs = []
+        # Imágenes (cache LRU/TTL por (item_id, variation_id), respaldada en ml_items_cache)
         variation_id = prod.get("variation_id")
-        if variation_id:
-            v = fetch_api(f"/items/{prod['id']}/variations/{variation_id}")
-            for pid in v.get("picture_ids", []):
-                imgs.append({
-                    "url": f"https://http2.mlstatic.com/D_{pid}-O.jpg",
-                    "thumbnail": f"https://http2.mlstatic.com/D_{pid}-I.jpg"
-                })
-        else:
-            p = fetch_api(f"/items/{prod['id']}")
-            for pic in p.get("pictures", []):
-                imgs.append({
-                    "url": pic.get("url", DEFAULT_IMG_LOCAL),
-                    "thumbnail": pic.get("secure_url", DEFAULT_IMG_LOCAL)
-                })
+        try:
+            meta = await obtener_item_meta(prod["id"], variation_id)
+            imgs = meta["imagenes"]
+        except Exception as e:
+            logger.warning("No se pudieron obtener imágenes de %s/%s: %s", prod.get("id"), variation_id, e)
+            imgs = []
 
         if not imgs:
             imgs = [{"url": DEFAULT_IMG_LOCAL, "thumbnail": DEFAULT_IMG_LOCAL}]
@@ -112,66 +114,59 @@ def parse_order_data(order_data: dict, shipment_id: str = None) -> dict:
 
 
 
-def get_valid_token():
+async def gather_acotado(coros, limite: int = ORDER_CONCURRENCY, timeout: float = ORDER_TIMEOUT):
     """
-    Lee el archivo ml_token.json, verifica expiración y refresca si es necesario.
+    Corre las corrutinas con a lo sumo `limite` en paralelo y `timeout` por cada una.
+    Devuelve los resultados en el mismo orden de entrada; las que fallan o vencen
+    quedan como la excepción correspondiente (no cortan al resto).
     """
-    try:
-        with open(TOKEN_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-    except (json.JSONDecodeError, FileNotFoundError) as e:
-        logger.error("ml_token.json inválido o no existe: %s", e)
-        return None
+    sem = asyncio.Semaphore(max(1, limite))
 
-    token      = data.get("access_token")
-    created    = datetime.fromisoformat(data["created_at"])
-    expires_in = data.get("expires_in", 0)
-
-    # Si expiró (o está por expirar en menos de 60s), refrescamos:
-    if datetime.now() >= created + timedelta(seconds=expires_in - 60):
-        logger.debug("Token expirado o cercano a expirar, solicitando refresh...")
-        r = requests.post(f"{API_BASE}/oauth/token", data={
-            "grant_type":    "refresh_token",
-            "client_id":     CLIENT_ID,
-            "client_secret": CLIENT_SECRET,
-            "refresh_token": data.get("refresh_token")
-        })
-        r.raise_for_status()
-        new = r.json()
-        new["created_at"] = datetime.now().isoformat()
-        with open(TOKEN_FILE, "w", encoding="utf-8") as f2:
-            json.dump(new, f2, indent=2)
-        return new.get("access_token")
+    async def _uno(coro):
+        async with sem:
+            return await asyncio.wait_for(coro, timeout)
 
-    return token
+    return await asyncio.gather(*(_uno(c) for c in coros), return_exceptions=True)
 
 
-def fetch_api(path, params=None, extra_headers=None):
+def _pares_items(order_data: dict) -> list:
+    """[(item_id, variation_id)] de las líneas de una orden."""
+    pares = []
+    for oi in order_data.get("order_items", []) or order_data.get("items", []):
+        prod = oi.get("item", oi)
+        if prod.get("id"):
+            pares.append((prod["id"], prod.get("variation_id")))
+    return pares
+
+
+def get_valid_token():
     """
-    GET genérico a api.mercadolibre.com con manejo de token.
+    Token vigente desde el token manager de auth_ml (en memoria, refresh single-flight).
     """
-    token = get_valid_token()
-    if not token:
-        raise RuntimeError("No hay token válido para llamar a la API de Mercado Libre")
-    headers = {"Authorization": f"Bearer {token}"}
-    if extra_headers:
-        headers.update(extra_headers)
+    try:
+        return get_ml_token()
+    except Exception as e:
+        logger.error("No se pudo obtener token de ML: %s", e)
+        return None
+
+
+async def get_valid_token_async():
+    try:
+        return await get_ml_token_async()
+    except Exception as e:
+        logger.error("No se pudo obtener token de ML: %s", e)
+        return None
 
-    url = f"{API_BASE}{path}"
-    logger.debug("→ Llamando a ML API: GET %s  headers=%s  params=%s", url, headers, params)
-    r = requests.get(url, headers=headers, params=params)
-    r.raise_for_status()
-    return r.json()
 
-def buscar_order_completo(order_id, headers):
+async def buscar_order_completo(order_id, headers):
     """
     Intenta traer la orden por /orders/{id}, si falla intenta por /orders/search.
     """
     try:
-        return fetch_api(f"/orders/{order_id}", extra_headers=headers)
+        return await fetch_api_async(f"/orders/{order_id}", extra_headers=headers)
     except Exception:
         try:
-            result = fetch_api(f"/orders/search?seller=207035636&q={order_id}", extra_headers=headers)
+            result = await fetch_api_async(f"/orders/search?seller=207035636&q={order_id}", extra_headers=headers)
             return result["results"][0] if result.get("results") else None
         except Exception as e:
             logger.warning("No se encontró la orden %s ni por /orders ni por /orders/search: %s", order_id, e)
@@ -179,33 +174,132 @@ def buscar_order_completo(order_id, headers):
 
 
 
-async def get_order_details(order_id: str = None, shipment_id: str = None, db: Session = None) -> dict:
-    token = get_valid_token()
+# Single-flight de get_order_details: una resolución en vuelo por shipment/order y por loop
+_en_vuelo = weakref.WeakKeyDictionary()   # loop -> {("shipment"|"order", id): Task}
+_coalescencia = {"resoluciones": 0, "coalescidas": 0}
+
+
+def estadisticas_coalescencia() -> dict:
+    """Resoluciones reales hacia ML vs. pedidos que esperaron una ya en vuelo."""
+    return {**_coalescencia, "en_vuelo": sum(len(v) for v in list(_en_vuelo.values()))}
+
+
+async def get_order_details(order_id: str = None, shipment_id: str = None, db: Session = None,
+                            forzar: bool = False) -> dict:
+    """
+    Resuelve un envío/orden. Si ya hay una resolución en curso para el mismo
+    shipment_id (u order_id), se espera esa y se comparte su resultado.
+    forzar=True saltea la política de TTL de la cache y vuelve a resolver contra ML.
+    """
+    if shipment_id:
+        clave = ("shipment", str(shipment_id).strip())
+    elif order_id:
+        clave = ("order", str(order_id).strip())
+    else:
+        return await _get_order_details(order_id, shipment_id, db, forzar=forzar)
+
+    loop = asyncio.get_running_loop()
+    vuelo = _en_vuelo.setdefault(loop, {})
+    task = vuelo.get(clave)
+    if task is not None:
+        _coalescencia["coalescidas"] += 1
+        logger.debug("Coalescido get_order_details %s=%s", *clave)
+        return copy.deepcopy(await asyncio.shield(task))
+
+    # La resolución compartida usa su propia sesión: puede sobrevivir al request que la inició
+    task = loop.create_task(_resolver_compartido(order_id, shipment_id, db is not None, forzar=forzar))
+    vuelo[clave] = task
+    task.add_done_callback(lambda t: vuelo.pop(clave, None) if vuelo.get(clave) is t else None)
+    _coalescencia["resoluciones"] += 1
+    return await asyncio.shield(task)
+
+
+async def _resolver_compartido(order_id, shipment_id, usar_db: bool, forzar: bool = False) -> dict:
+    if not usar_db:
+        return await _get_order_details(order_id, shipment_id, None)
+    db = SessionLocal()
+    try:
+        return await _get_order_details(order_id, shipment_id, db, forzar=forzar)
+    finally:
+        db.close()
+
+
+# Refrescos stale-while-revalidate en background: uno por envío y por loop. Van aparte
+# de _en_vuelo a propósito: quien encuentra la fila "stale" la sirve ya, no espera el refresh.
+_refrescando = weakref.WeakKeyDictionary()   # loop -> {shipment_id: Task}
+
+
+def _refrescar_en_background(shipment_id: str):
+    sid = str(shipment_id).strip()
+    loop = asyncio.get_running_loop()
+    refrescos = _refrescando.setdefault(loop, {})
+    if sid in refrescos:
+        return
+    registrar("refresh_bg")
+    task = loop.create_task(_resolver_compartido(None, sid, True, forzar=True))
+    refrescos[sid] = task
+    _coalescencia["resoluciones"] += 1
+
+    def _fin(t):
+        if refrescos.get(sid) is t:
+            refrescos.pop(sid, None)
+        if not t.cancelled() and t.exception():
+            logger.warning("Refresh en background de %s falló: %r", sid, t.exception())
+    task.add_done_callback(_fin)
+
+
+def _frescura(cache):
+    """Momento en que la fila se supo vigente por última vez (alta/refresh o revalidación 304)."""
+    marcas = [m if m.tzinfo else m.replace(tzinfo=timezone.utc)
+              for m in (cache.fecha_consulta, cache.validado_en) if m]
+    return max(marcas) if marcas else None
+
+
+def _esta_enriquecido(detalle) -> bool:
+    return isinstance(detalle, list) and bool(detalle) and isinstance(detalle[0], dict) and "titulo" in detalle[0]
+
+
+def _resultado_desde_cache(cache) -> dict:
+    return {
+        "cliente": cache.cliente,
+        "items": cache.detalle,
+        "estado_envio": cache.estado_envio,
+        "estado_ml": cache.estado_ml,
+        "primer_order_id": cache.order_id,
+        "primer_shipment_id": cache.shipment_id,
+    }
+
+
+async def _get_order_details(order_id: str = None, shipment_id: str = None, db: Session = None,
+                             forzar: bool = False) -> dict:
+    token = await get_valid_token_async()
     if not token:
         logger.error("No se obtuvo token válido")
         return {"cliente": "Error", "items": [], "primer_order_id": None}
 
     headers = {"Authorization": f"Bearer {token}"}
-    TTL_MINUTOS = 10
 
-    # 1️⃣ Intentar traer desde cache
+    # 1️⃣ Intentar traer desde cache (TTL según estado/logística, ver cache_ml.py)
+    cache = None
     if db and shipment_id:
         cache = db.query(MLPedidoCache).filter_by(shipment_id=shipment_id).first()
-        if cache and cache.fecha_consulta and datetime.now(timezone.utc) - cache.fecha_consulta < timedelta(minutes=TTL_MINUTOS):
-            logger.info("Se usó cache fresca para shipment_id=%s", shipment_id)
-            return {
-                "cliente": cache.cliente,
-                "items": cache.detalle,
-                "estado_envio": cache.estado_envio,
-                "estado_ml": cache.estado_ml,
-                "primer_order_id": cache.order_id,
-                "primer_shipment_id": cache.shipment_id,
-            }
+        if not forzar:
+            resultado = (clasificar(_frescura(cache), cache.estado_ml, cache.logistic_type)
+                         if cache else "miss")
+            registrar(resultado)
+            if resultado == "hit":
+                logger.info("Se usó cache fresca para shipment_id=%s", shipment_id)
+                return _resultado_desde_cache(cache)
+            if resultado == "stale":
+                # stale-while-revalidate: se sirve ya y se refresca una sola vez en background
+                logger.info("Cache vencida en gracia para shipment_id=%s, se refresca en background", shipment_id)
+                _refrescar_en_background(shipment_id)
+                return _resultado_desde_cache(cache)
 
     # 2️⃣ Consultar directamente por order_id (con fallback a /orders/search)
     if order_id:
         try:
-            od = buscar_order_completo(order_id, headers)
+            od = await buscar_order_completo(order_id, headers)
             if not od:
                 return {"cliente": "Error", "items": [], "primer_order_id": order_id}
 
@@ -213,7 +307,7 @@ async def get_order_details(order_id: str = None, shipment_id: str = None, db: S
             shipment_id = str(od.get("shipping", {}).get("id") or "")
 
             await guardar_pedido_en_cache(od, db, order_id)
-            parsed = parse_order_data(od)
+            parsed = await parse_order_data(od)
             parsed["primer_order_id"] = order_id
             parsed["shipment_id"] = shipment_id
             parsed["estado_ml"] = shipment_status
@@ -225,17 +319,40 @@ async def get_order_details(order_id: str = None, shipment_id: str = None, db: S
     # 3️⃣ SHIPMENT_ID FLUJO COMPLETO (esto estaba mal ubicado)
     if shipment_id:
         try:
-            shipment_items = fetch_api(
+            # Items y estado del envío en paralelo
+            # (condicionales: si ML responde 304 usamos el cuerpo guardado).
+            # Si hay un snapshot vigente del envío (p.ej. lo acaba de traer /armar o el
+            # calentamiento) no se vuelve a pedir /shipments/{id}.
+            # Los ETag/Last-Modified de los 200 se guardan recién cuando la fila de cache
+            # quedó escrita (si no, un 304 posterior revalidaría una fila vieja)
+            validadores = []
+            snap = snapshot_vigente(shipment_id)
+            llamadas = [fetch_api_condicional(
                 f"/shipments/{shipment_id}/items",
-                extra_headers={**headers, "x-format-new": "true"}
-            )
-
-            try:
-                shipment_data = fetch_api(f"/shipments/{shipment_id}", extra_headers=headers)
-                shipment_status = shipment_data.get("status", "desconocido")
-            except Exception as e:
-                logger.warning("No se pudo obtener el estado del envío: %s", e)
+                extra_headers={**headers, "x-format-new": "true"},
+                validadores=validadores,
+            )]
+            if snap is None:
+                llamadas.append(fetch_api_condicional(f"/shipments/{shipment_id}", extra_headers=headers,
+                                                      validadores=validadores))
+            resp_items, *resp_envio = await asyncio.gather(*llamadas, return_exceptions=True)
+            if isinstance(resp_items, BaseException):
+                raise resp_items
+            shipment_items, items_modificados = resp_items
+            resp_envio = resp_envio[0] if resp_envio else None
+
+            if snap is not None:
+                shipment_status = snap.get("status") or "desconocido"
+                envio_modificado = cache is None or cache.estado_ml != shipment_status
+            elif isinstance(resp_envio, BaseException):
+                logger.warning("No se pudo obtener el estado del envío: %s", resp_envio)
                 shipment_status = "desconocido"
+                envio_modificado = True
+            else:
+                shipment_data, envio_modificado = resp_envio
+                shipment_status = shipment_data.get("status", "desconocido")
+                # El resto del flujo (logistic_type al guardar, /armar) reutiliza este snapshot
+                guardar_snapshot(shipment_id, shipment_data)
 
             estado_traducido = {
                 "pending": "Pendiente", "ready_to_ship": "Listo para armar", "shipped": "Enviado",
@@ -250,31 +367,50 @@ async def get_order_details(order_id: str = None, shipment_id: str = None, db: S
 
             all_items = []
             cliente = None
-            primer_oid = None
+            oids = [entry.get("order_id") for entry in shipment_items if entry.get("order_id")]
+            primer_oid = oids[0] if oids else None
 
-            for entry in shipment_items:
-                oid = entry.get("order_id")
-                if not oid:
+            # Órdenes del envío en paralelo (acotado); el orden de resultados es el de oids
+            respuestas = await gather_acotado(
+                fetch_api_condicional(f"/orders/{oid}", extra_headers=headers, validadores=validadores)
+                for oid in oids
+            )
+            ordenes = []
+            modificado = items_modificados or envio_modificado
+            for oid, resp in zip(oids, respuestas):
+                if isinstance(resp, BaseException):
+                    logger.warning("/orders/%s devolvió error: %r", oid, resp)
+                    modificado = True
                     continue
-                if primer_oid is None:
-                    primer_oid = oid
-
-                try:
-                    od = fetch_api(f"/orders/{oid}", extra_headers=headers)
-                except Exception as e:
-                    logger.warning("/orders/%s devolvió error: %s", oid, e)
+                od, orden_modificada = resp
+                modificado = modificado or orden_modificada
+                ordenes.append(od)
+
+            # Nada cambió en ML desde la última vez (todo 304): no re-parsear ni re-enriquecer
+            if cache is not None and not modificado and _esta_enriquecido(cache.detalle):
+                (db.query(MLPedidoCache)
+                   .filter(MLPedidoCache.shipment_id == shipment_id)
+                   .update({MLPedidoCache.validado_en: datetime.now(timezone.utc)}, synchronize_session=False))
+                db.commit()
+                logger.info("Shipment %s sin cambios en ML (304), cache revalidada", shipment_id)
+                return _resultado_desde_cache(cache)
+
+            # Resolver todos los ítems del envío de una vez (multi-get) antes de parsear
+            await precargar_items([p for od in ordenes for p in _pares_items(od)])
+
+            # Procesar las órdenes completas sin filtrar (también acotado y en orden)
+            parseadas = await gather_acotado(parse_order_data(od) for od in ordenes)
+            for od, detalle_completo in zip(ordenes, parseadas):
+                if isinstance(detalle_completo, BaseException):
+                    logger.warning("Error parseando orden %s: %r", od.get("id"), detalle_completo)
                     continue
-
                 if cliente is None:
                     cliente = od.get("buyer", {}).get("nickname", "Cliente desconocido")
-
-                # Procesar la orden completa sin filtrar
-                detalle_completo = parse_order_data(od)
                 if detalle_completo.get("items"):
                     all_items.extend(detalle_completo["items"])
 
 
-            await enriquecer_permalinks(all_items, token, db)
+            await enriquecer_permalinks(all_items)
             await enriquecer_items_ws(all_items, db)
 
             if all_items:
@@ -294,10 +430,15 @@ async def get_order_details(order_id: str = None, shipment_id: str = None, db: S
                         cliente=cliente,
                         estado_envio=estado_envio,
                         estado_ml=shipment_status,
-                        detalle=all_items
+                        detalle=all_items,
+                        # fecha_consulta es server_default (solo en el alta): la frescura
+                        # de un refresh queda en validado_en (ver _frescura)
+                        validado_en=datetime.now(timezone.utc),
                     )
                     db.merge(nuevo)
                     db.commit()
+                    await guardar_validadores(validadores)
+                    await asyncio.to_thread(actualizar_contadores_envio, shipment_id)
 
                 return resultado
 
@@ -324,18 +465,19 @@ def _dedupe_items(items):
     return list(out.values())
 
 
-def guardar_pedido_cache(
+async def guardar_pedido_cache(
     db: Session,
     shipment_id: str,
     order_id: str,
     cliente: str,
     estado_envio: str,
     estado_ml: str,
-    detalle: dict   # acá te llega list[dict] (items)
+    detalle: dict,   # acá te llega list[dict] (items)
+    propagar_error: bool = False,
 ):
     try:
         # 🧠 logistic_type desde ML
-        logistic_type = obtener_logistic_type_desde_envio(shipment_id)
+        logistic_type = await obtener_logistic_type_desde_envio(shipment_id)
 
         if not isinstance(detalle, list):
             detalle = detalle.get("items", []) if isinstance(detalle, dict) else []
@@ -357,6 +499,7 @@ def guardar_pedido_cache(
             row.estado_ml     = estado_ml
             row.detalle       = items            # 👈 reemplaza, NO acumula
             row.logistic_type = logistic_type
+            row.validado_en   = datetime.now(timezone.utc)   # frescura del refresh (ver _frescura)
         else:
             cache = MLPedidoCache(
                 shipment_id=str(shipment_id).strip(),
@@ -365,11 +508,13 @@ def guardar_pedido_cache(
                 estado_envio=estado_envio,
                 estado_ml=estado_ml,
                 detalle=items,                   # 👈 ya deduplicado
-                logistic_type=logistic_type
+                logistic_type=logistic_type,
+                validado_en=datetime.now(timezone.utc),
             )
             db.add(cache)
 
         db.commit()
+        await asyncio.to_thread(actualizar_contadores_envio, shipment_id)
 
         print(f"💾 Pedido {order_id} commit a la base de datos")
         print(f"🧪 logistic_type extraído: {logistic_type}")
@@ -388,10 +533,13 @@ def guardar_pedido_cache(
 
     except Exception as e:
         print(f"💥 Error al guardar pedido {order_id}: {e}")
+        if propagar_error:
+            raise
 
 
 
-async def guardar_pedido_en_cache(pedido: dict, db: Session, order_id: str):
+async def guardar_pedido_en_cache(pedido: dict, db: Session, order_id: str, propagar_error: bool = False):
+    # propagar_error=True lo usan los workers de webhooks para reintentar con backoff
     try:
         # 1) Resolver shipment_id
         shipment_id = (
@@ -400,26 +548,27 @@ async def guardar_pedido_en_cache(pedido: dict, db: Session, order_id: str):
             or pedido.get("shipment", {}).get("id")
         )
         if not shipment_id:
-            token = get_valid_token()
-            r = requests.get(f"https://api.mercadolibre.com/orders/{order_id}",
-                             headers={"Authorization": f"Bearer {token}"})
-            if r.ok:
-                shipment_id = r.json().get("shipping", {}).get("id")
+            try:
+                o = await fetch_api_async(f"/orders/{order_id}")
+                shipment_id = o.get("shipping", {}).get("id")
+            except Exception:
+                pass
         if not shipment_id:
             print(f"⚠️ Pedido {order_id} no tiene shipment_id. No se guarda en cache.")
             return
         shipment_id = str(shipment_id)
 
         # 2) Normalizar ítems (lo que espera el front)
-        parsed = parse_order_data(pedido, shipment_id=shipment_id)
+        parsed = await parse_order_data(pedido, shipment_id=shipment_id)
         items = _dedupe_items(parsed.get("items", []))   # 👈 dedupe acá
         cliente = parsed.get("cliente", "")
 
 
-        # 3) Estados
+        # 3) Estados (lo que se guarda vive todo el TTL de la cache: no usar un snapshot anterior)
+        invalidar_snapshot(shipment_id)
         estado_raw = None
         try:
-            s = fetch_api(f"/shipments/{shipment_id}")   # si falla, caemos al de la orden
+            s = await obtener_snapshot_envio(shipment_id)   # si falla, caemos al de la orden
             estado_raw = s.get("status")
         except Exception:
             pass
@@ -434,13 +583,12 @@ async def guardar_pedido_en_cache(pedido: dict, db: Session, order_id: str):
         estado_envio = estado_traducido.get(estado_raw, estado_raw.replace("_", " ").capitalize())
         estado_ml = estado_raw
                 # 4) Enriquecer (permalinks + WS) sobre la lista **normalizada**
-        token = get_valid_token()
         if items:
-            await enriquecer_permalinks(items, token, db)
+            await enriquecer_permalinks(items)
             await enriquecer_items_ws(items, db)
 
         # 5) Guardar NORMALIZADO en cache
-        guardar_pedido_cache(
+        await guardar_pedido_cache(
             db=db,
             shipment_id=shipment_id,
             order_id=order_id,
@@ -448,20 +596,19 @@ async def guardar_pedido_en_cache(pedido: dict, db: Session, order_id: str):
             estado_envio=estado_envio,
             estado_ml=estado_ml,
             detalle=items,  # 👈 ahora es list[dict] con titulo/sku/variante/imagenes
+            propagar_error=propagar_error,
         )
         print(f"✅ Pedido {order_id} enriquecido y guardado en caché.")
     except Exception as e:
         print(f"❌ Error al guardar pedido {order_id}: {e}")
+        if propagar_error:
+            raise
 
 
-def obtener_logistic_type_desde_envio(shipment_id: str) -> str | None:
+async def obtener_logistic_type_desde_envio(shipment_id: str) -> str | None:
     try:
-        token = get_valid_token()
-        url = f"https://api.mercadolibre.com/shipments/{shipment_id}"
-        headers = {"Authorization": f"Bearer {token}"}
-        r = requests.get(url, headers=headers)
-        if r.ok:
-            return r.json().get("logistic_type")
+        s = await obtener_snapshot_envio(shipment_id)
+        return s.get("logistic_type")
     except Exception as e:
         print(f"⚠️ Error al obtener logistic_type de shipment {shipment_id}: {e}")
     return None
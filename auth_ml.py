@@ -1,8 +1,16 @@
 # auth_ml.py
-import os, json, time, webbrowser, requests
+import os, json, time, webbrowser, requests, threading, asyncio, logging
+from contextlib import contextmanager
 from datetime import datetime, timezone
 from pathlib import Path
 
+try:
+    import fcntl  # lock entre workers de uvicorn (Linux/macOS)
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
 # ===== CREDENCIALES (podés dejarlas acá o pasarlas por env) =====
 CLIENT_ID = os.getenv("ML_CLIENT_ID", "5569606371936049")
 CLIENT_SECRET = os.getenv("ML_CLIENT_SECRET", "wH7UDWXbA92DVlYa4P50cHBCLrEloMa0")
@@ -11,6 +19,17 @@ REDIRECT_URI = os.getenv("ML_REDIRECT_URI", "https://controlpedidos.onrender.com
 # Ruta del token (por env) con fallback a la carpeta del proyecto
 ROOT = Path(os.getenv("ML_ROOT", Path(__file__).resolve()).parent)
 TOKEN_PATH = Path(os.getenv("ML_TOKEN_PATH", ROOT / "ml_token.json"))
+LOCK_PATH = TOKEN_PATH.with_name(TOKEN_PATH.name + ".lock")
+
+# Refresh en background cuando faltan menos de REFRESH_AHEAD segundos;
+# refresh bloqueante si faltan menos de REFRESH_MIN (el token ya no sirve).
+REFRESH_AHEAD = int(os.getenv("ML_TOKEN_REFRESH_AHEAD", "600"))
+REFRESH_MIN = int(os.getenv("ML_TOKEN_REFRESH_MIN", "120"))
+
+# Token en memoria (por proceso); el archivo solo se lee al arrancar o al refrescar
+_token_data = None
+_token_lock = threading.Lock()
+_bg_lock = threading.Lock()  # tomado mientras corre un refresh en background
 
 
 def _to_epoch(v):
@@ -60,8 +79,9 @@ def obtener_token(code: str):
     data["created_at"] = now
     # ML devuelve expires_in (segundos). Guardamos expires_at para refrescar a tiempo.
     data["expires_at"] = _to_epoch(data.get("created_at")) + int(data.get("expires_in", 0))
-    TOKEN_PATH.parent.mkdir(parents=True, exist_ok=True)
-    TOKEN_PATH.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+    with _file_lock():
+        _guardar_token(data)
+    _set_token(data)
 
     print("✅ Token guardado en", TOKEN_PATH)
     print("🔑 Access Token:", data["access_token"])
@@ -85,26 +105,115 @@ def _refrescar_token(refresh_token: str):
     # Mantener último refresh_token si ML no lo devuelve
     if "refresh_token" not in data:
         data["refresh_token"] = refresh_token
-    TOKEN_PATH.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+    _guardar_token(data)
     return data
 
 def _cargar_token():
     if not TOKEN_PATH.exists():
         raise FileNotFoundError(f"Token file not found: {TOKEN_PATH}")
-    return json.loads(TOKEN_PATH.read_text(encoding="utf-8"))
+    return _normalizar(json.loads(TOKEN_PATH.read_text(encoding="utf-8")))
+
+def _guardar_token(data: dict):
+    # Escritura atómica: otro worker nunca lee un JSON a medio escribir
+    TOKEN_PATH.parent.mkdir(parents=True, exist_ok=True)
+    tmp = TOKEN_PATH.with_name(TOKEN_PATH.name + f".{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp, TOKEN_PATH)
+
+def _normalizar(data: dict) -> dict:
+    """Unifica formatos viejos (created_at ISO) y nuevos (epoch) en expires_at epoch."""
+    if not data.get("expires_at") and "created_at" in data and "expires_in" in data:
+        data["expires_at"] = _to_epoch(data["created_at"]) + int(data["expires_in"])
+    data["expires_at"] = _to_epoch(data.get("expires_at", 0))
+    return data
+
+def _set_token(data: dict):
+    global _token_data
+    _token_data = data
+
+def _restante(data) -> int:
+    if not data:
+        return 0
+    return int(data.get("expires_at", 0)) - int(time.time())
+
+@contextmanager
+def _file_lock():
+    """Lock exclusivo entre procesos (workers de uvicorn) sobre ml_token.json.lock."""
+    if fcntl is None:
+        yield
+        return
+    LOCK_PATH.parent.mkdir(parents=True, exist_ok=True)
+    with open(LOCK_PATH, "a") as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+def _refrescar_single_flight(margen: int) -> dict:
+    """
+    Refresca el token si le quedan menos de `margen` segundos.
+    Un solo refresh a la vez: lock de hilo dentro del proceso + file lock entre workers.
+    Si otro hilo/worker ya refrescó, se adopta su token sin llamar a /oauth/token.
+    """
+    with _token_lock:
+        data = _token_data
+        if _restante(data) > margen:
+            return data
+        with _file_lock():
+            data = _cargar_token()   # otro worker pudo haber refrescado ya
+            if _restante(data) <= margen:
+                logger.info("Refrescando token de ML (quedan %ss)", _restante(data))
+                data = _refrescar_token(data["refresh_token"])
+            _set_token(data)
+            return data
+
+def _refresh_en_background():
+    if not _bg_lock.acquire(blocking=False):
+        return
+
+    def _run():
+        try:
+            _refrescar_single_flight(REFRESH_AHEAD)
+        except Exception as e:
+            logger.warning("Refresh en background del token ML falló: %s", e)
+        finally:
+            _bg_lock.release()
+
+    threading.Thread(target=_run, name="ml-token-refresh", daemon=True).start()
+
+def _token_en_memoria():
+    """Devuelve el token en memoria si todavía sirve; None si hay que refrescar ya."""
+    data = _token_data
+    if data is None:
+        with _token_lock:
+            if _token_data is None:
+                _set_token(_cargar_token())
+            data = _token_data
+    restante = _restante(data)
+    if restante <= REFRESH_MIN:
+        return None
+    if restante <= REFRESH_AHEAD:
+        _refresh_en_background()
+    return data["access_token"]
 
 def get_ml_token() -> str:
     """
     Usala en todas tus llamadas a la API.
-    Auto-refresca si faltan <120s para el vencimiento.
+    Lee el token de memoria; lo refresca en background antes de que venza
+    y solo bloquea (una vez, para todos) si ya está por expirar.
     """
-    data = _cargar_token()
-    # Si no tenemos expires_at (tokens viejos), lo calculamos
-    if "expires_at" not in data and "created_at" in data and "expires_in" in data:
-        data["expires_at"] = int(data["created_at"]) + int(data["expires_in"])
-    # Refresh si está cerca de expirar
-    if int(time.time()) >= int(data.get("expires_at", 0)) - 120:
-        data = _refrescar_token(data["refresh_token"])
+    token = _token_en_memoria()
+    if token:
+        return token
+    return _refrescar_single_flight(REFRESH_MIN)["access_token"]
+
+async def get_ml_token_async() -> str:
+    """Igual que get_ml_token, pero el refresh bloqueante corre fuera del event loop."""
+    token = _token_en_memoria()
+    if token:
+        return token
+    data = await asyncio.to_thread(_refrescar_single_flight, REFRESH_MIN)
     return data["access_token"]
 
 # ---------- Uso manual ----------
@@ -0,0 +1,109 @@
+# cache_ml.py
+"""
+Política de frescura de ml_pedidos_cache.
+
+El TTL depende del estado del envío (un delivered/cancelled prácticamente no
+cambia; un ready_to_ship sí) y se escala según logistic_type. Pasado el TTL
+hay una ventana de gracia en la que la fila se sirve igual ("stale") mientras
+se refresca en background; recién después se considera vencida.
+
+Se puede ajustar con ML_CACHE_POLITICA (JSON con las mismas secciones que
+POLITICA_DEFAULT; lo que se pase pisa la clave correspondiente), p.ej.:
+    ML_CACHE_POLITICA='{"ttl_min": {"ready_to_ship": 2}, "gracia_min": {"default": 10}}'
+"""
+import os
+import json
+import math
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+
+logger = logging.getLogger(__name__)
+
+POLITICA_DEFAULT = {
+    # minutos de frescura por estado_ml
+    "ttl_min": {
+        "ready_to_ship": 5, "handling": 5, "pending": 10, "shipped": 60,
+        "not_delivered": 240, "delivered": 1440, "cancelled": 1440, "returned": 1440,
+        "default": 10,
+    },
+    # minutos extra en los que se sirve la fila vencida mientras se refresca
+    "gracia_min": {"ready_to_ship": 15, "handling": 15, "default": 30},
+    # multiplicador del TTL por logistic_type (flex cambia más seguido)
+    "factor_logistica": {"self_service": 0.5, "default": 1.0},
+}
+
+
+def _cargar_politica() -> dict:
+    """
+    POLITICA_DEFAULT pisada con ML_CACHE_POLITICA. Solo se aceptan secciones conocidas
+    con valores numéricos; ante cualquier cosa mal formada se usa entera la de defecto.
+    """
+    politica = {k: dict(v) for k, v in POLITICA_DEFAULT.items()}
+    crudo = os.getenv("ML_CACHE_POLITICA")
+    if not crudo:
+        return politica
+    try:
+        override = json.loads(crudo)
+        if not isinstance(override, dict):
+            raise ValueError("se esperaba un objeto JSON")
+        for seccion, valores in override.items():
+            if seccion not in politica:
+                raise ValueError(f"sección desconocida {seccion!r}")
+            if not isinstance(valores, dict):
+                raise ValueError(f"{seccion} debe ser un objeto")
+            for clave, valor in valores.items():
+                numero = float(valor) if not isinstance(valor, bool) else math.nan
+                if not (math.isfinite(numero) and numero >= 0):
+                    raise ValueError(f"{seccion}.{clave} debe ser un número >= 0")
+                politica[seccion][clave] = numero
+    except (ValueError, TypeError) as e:
+        logger.error("ML_CACHE_POLITICA inválida, se usa la política por defecto: %s", e)
+        return {k: dict(v) for k, v in POLITICA_DEFAULT.items()}
+    return politica
+
+
+POLITICA = _cargar_politica()
+
+_stats_lock = threading.Lock()
+_stats = {"hit": 0, "stale": 0, "miss": 0, "refresh_bg": 0}
+
+
+def _valor(seccion: str, clave):
+    tabla = POLITICA[seccion]
+    return tabla.get(clave, tabla["default"])
+
+
+def ttl_para(estado_ml, logistic_type=None):
+    """(ttl, gracia) como timedelta para un envío en ese estado / logística."""
+    ttl = _valor("ttl_min", estado_ml) * _valor("factor_logistica", logistic_type)
+    return timedelta(minutes=ttl), timedelta(minutes=_valor("gracia_min", estado_ml))
+
+
+def clasificar(frescura, estado_ml, logistic_type=None, ahora=None) -> str:
+    """
+    "hit" dentro del TTL, "stale" dentro de la gracia, "miss" si está vencida
+    o no hay marca de frescura.
+    """
+    if frescura is None:
+        return "miss"
+    ttl, gracia = ttl_para(estado_ml, logistic_type)
+    edad = (ahora or datetime.now(timezone.utc)) - frescura
+    if edad < ttl:
+        return "hit"
+    if edad < ttl + gracia:
+        return "stale"
+    return "miss"
+
+
+def registrar(resultado: str):
+    with _stats_lock:
+        _stats[resultado] += 1
+
+
+def estadisticas_cache() -> dict:
+    with _stats_lock:
+        stats = dict(_stats)
+    total = stats["hit"] + stats["stale"] + stats["miss"]
+    stats["tasa_hit"] = round((stats["hit"] + stats["stale"]) / total, 3) if total else 0.0
+    return stats
@@ -0,0 +1,197 @@
+# calentamiento.py
+"""
+Precalentado de ml_pedidos_cache antes del turno.
+
+Recorre las órdenes pagas recientes del vendedor, se queda con los envíos en
+ready_to_ship y los resuelve con get_order_details (ML + permalinks + WS), así
+durante el turno casi todo escaneo es un hit de cache.
+
+Uso:
+    python calentamiento.py [--dias 3] [--concurrencia 4] [--forzar]
+o programado dentro de la app con CALENTAR_HORA=HH:MM.
+"""
+import os
+import asyncio
+import logging
+import argparse
+import time
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+try:
+    import fcntl  # lock entre workers de uvicorn (Linux/macOS)
+except ImportError:
+    fcntl = None
+
+if __name__ == "__main__":
+    # Como CLI corre fuera de la app: DATABASE_URL y ML_* desde el .env (no pisa el entorno).
+    # Tiene que ir antes de importar api_ml / database, que leen el entorno al importarse.
+    from dotenv import load_dotenv
+    load_dotenv()
+
+from api_ml import get_order_details, gather_acotado, fetch_api_async, ORDER_CONCURRENCY
+from envios_ml import obtener_snapshot_envio
+from database.connection import SessionLocal
+from database.models import MLPedidoCache
+
+logger = logging.getLogger(__name__)
+
+ML_SELLER_ID = os.getenv("ML_SELLER_ID", "207035636")
+CALENTAR_DIAS = int(os.getenv("CALENTAR_DIAS", "3"))
+CALENTAR_ESTADOS = {e.strip() for e in os.getenv("CALENTAR_ESTADOS", "ready_to_ship").split(",") if e.strip()}
+CALENTAR_HORA = os.getenv("CALENTAR_HORA", "")          # "HH:MM" hora local; vacío = sin programar
+CALENTAR_MAX_ORDENES = int(os.getenv("CALENTAR_MAX_ORDENES", "2000"))
+PAGINA = 50   # máximo que acepta /orders/search
+CALENTAR_LOCK_PATH = Path(os.getenv("CALENTAR_LOCK_PATH", Path(__file__).resolve().parent / "calentamiento.lock"))
+
+
+async def listar_envios_abiertos(dias: int = CALENTAR_DIAS) -> list:
+    """shipment_ids de las órdenes pagas de los últimos `dias` (paginando /orders/search)."""
+    desde = (datetime.now(timezone.utc) - timedelta(days=dias)).strftime("%Y-%m-%dT%H:%M:%S.000-00:00")
+    sids, offset = [], 0
+    while offset < CALENTAR_MAX_ORDENES:
+        res = await fetch_api_async("/orders/search", params={
+            "seller": ML_SELLER_ID,
+            "order.status": "paid",
+            "order.date_created.from": desde,
+            "sort": "date_desc",
+            "limit": PAGINA,
+            "offset": offset,
+        })
+        resultados = res.get("results", [])
+        for od in resultados:
+            sid = (od.get("shipping") or {}).get("id")
+            if sid:
+                sids.append(str(sid))
+        offset += PAGINA
+        if not resultados or offset >= res.get("paging", {}).get("total", 0):
+            break
+    return list(dict.fromkeys(sids))
+
+
+async def _filtrar_por_estado(sids: list, concurrencia: int) -> list:
+    # Vía snapshot: get_order_details reutiliza este mismo /shipments/{id} en vez de volver a pedirlo
+    estados = await gather_acotado((obtener_snapshot_envio(sid) for sid in sids), limite=concurrencia)
+    return [sid for sid, s in zip(sids, estados)
+            if not isinstance(s, BaseException) and s.get("status") in CALENTAR_ESTADOS]
+
+
+def _ya_enriquecidos(sids: list) -> set:
+    session = SessionLocal()
+    try:
+        recs = session.query(MLPedidoCache.shipment_id, MLPedidoCache.detalle) \
+                      .filter(MLPedidoCache.shipment_id.in_(sids)).all()
+    finally:
+        session.close()
+    return {sid for sid, detalle in recs
+            if isinstance(detalle, list) and detalle and isinstance(detalle[0], dict) and "titulo" in detalle[0]}
+
+
+async def calentar_cache(dias: int = CALENTAR_DIAS, concurrencia: int = ORDER_CONCURRENCY, forzar: bool = False) -> dict:
+    """
+    Deja en cache (enriquecidos) los envíos abiertos. Con forzar=False saltea los
+    que ya tienen filas enriquecidas; con forzar=True los re-resuelve todos contra ML
+    aunque la cache esté dentro del TTL. Devuelve contadores de la corrida.
+    """
+    t0 = time.perf_counter()
+    sids = await listar_envios_abiertos(dias)
+    abiertos = await _filtrar_por_estado(sids, concurrencia)
+    ya = set() if forzar else await asyncio.to_thread(_ya_enriquecidos, abiertos)
+    pendientes = [sid for sid in abiertos if sid not in ya]
+
+    db = SessionLocal()   # get_order_details abre su propia sesión; esta solo habilita el guardado
+    try:
+        resultados = await gather_acotado(
+            (get_order_details(shipment_id=sid, db=db, forzar=forzar) for sid in pendientes),
+            limite=concurrencia,
+            timeout=120,
+        )
+    finally:
+        db.close()
+
+    errores = sum(1 for r in resultados
+                  if isinstance(r, BaseException) or r.get("cliente") == "Error" or not r.get("items"))
+    stats = {
+        "ordenes_envios": len(sids),
+        "abiertos": len(abiertos),
+        "ya_en_cache": len(ya),
+        "calentados": len(pendientes) - errores,
+        "errores": errores,
+        "segundos": round(time.perf_counter() - t0, 1),
+    }
+    logger.info("Calentamiento de cache: %s", stats)
+    return stats
+
+
+def _segundos_hasta(hora: str) -> float:
+    hh, mm = (int(x) for x in hora.split(":"))
+    ahora = datetime.now()
+    prox = ahora.replace(hour=hh, minute=mm, second=0, microsecond=0)
+    if prox <= ahora:
+        prox += timedelta(days=1)
+    return (prox - ahora).total_seconds()
+
+
+@contextmanager
+def _turno_del_dia():
+    """
+    Lock no bloqueante entre procesos sobre CALENTAR_LOCK_PATH. Da True solo al worker
+    que lo consigue y si hoy todavía no se calentó (la fecha queda escrita en el archivo);
+    el resto recibe False y saltea la corrida.
+    """
+    if fcntl is None:
+        yield True
+        return
+    CALENTAR_LOCK_PATH.parent.mkdir(parents=True, exist_ok=True)
+    with open(CALENTAR_LOCK_PATH, "a+") as fh:
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            hoy = date.today().isoformat()
+            fh.seek(0)
+            if fh.read().strip() == hoy:
+                yield False
+                return
+            yield True
+            fh.truncate(0)
+            fh.write(hoy)
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+async def calentamiento_programado():
+    """
+    Corre calentar_cache todos los días a CALENTAR_HORA (tarea de fondo de la app).
+    Todos los workers de uvicorn la programan, pero calienta uno solo por día.
+    """
+    while True:
+        await asyncio.sleep(_segundos_hasta(CALENTAR_HORA))
+        try:
+            with _turno_del_dia() as me_toca:
+                if me_toca:
+                    await calentar_cache()
+                else:
+                    logger.info("Calentamiento de cache: ya lo corre (o corrió) otro worker")
+        except Exception as e:
+            logger.error("Calentamiento de cache falló: %s", e)
+
+
+if __name__ == "__main__":
+    from http_ml import aclose_async_client
+
+    parser = argparse.ArgumentParser(description="Precalienta ml_pedidos_cache con los envíos listos para armar")
+    parser.add_argument("--dias", type=int, default=CALENTAR_DIAS, help="antigüedad máxima de las órdenes")
+    parser.add_argument("--concurrencia", type=int, default=ORDER_CONCURRENCY)
+    parser.add_argument("--forzar", action="store_true", help="re-resolver contra ML aunque ya estén en cache (ignora el TTL)")
+    args = parser.parse_args()
+
+    async def _main():
+        try:
+            return await calentar_cache(args.dias, args.concurrencia, args.forzar)
+        finally:
+            await aclose_async_client()
+
+    print(f"🔥 Calentamiento terminado: {asyncio.run(_main())}")
@@ -0,0 +1,216 @@
+# crud/dashboard.py
+import logging
+from datetime import datetime, timedelta, timezone, time
+
+from sqlalchemy import or_, case, func, update
+from sqlalchemy.orm import Session
+
+from database.connection import SessionLocal
+from database.models import MLPedidoCache, Pedido, DashboardContador, DashboardEnvio
+
+logger = logging.getLogger(__name__)
+
+CONTADORES = ("flex_total", "flex_armados", "colecta_total", "colecta_armados")
+LOGISTICAS = {"flex": "self_service", "colecta": "cross_docking"}
+
+
+def ventana_actual():
+    """Ventana de conteo: de ayer 14:00 a hoy 14:00 (UTC)."""
+    hoy = datetime.now(timezone.utc).date()
+    inicio = datetime.combine(hoy - timedelta(days=1), time(14, 0)).astimezone(timezone.utc)
+    fin    = datetime.combine(hoy,                 time(14, 0)).astimezone(timezone.utc)
+    return inicio, fin
+
+
+# --- Queries base (las mismas para el recálculo completo y para el aporte de un shipment) ---
+
+def _q_total(db: Session, logistic_type, inicio, fin):
+    """Shipments de la logística que NO están armados (excluye cancelados y FULL)."""
+    return (
+        db.query(MLPedidoCache.shipment_id)
+          .filter(
+              MLPedidoCache.estado_ml != 'cancelled',
+              MLPedidoCache.fecha_consulta.between(inicio, fin),
+              MLPedidoCache.logistic_type == logistic_type,
+              MLPedidoCache.logistic_type != 'fulfillment',
+          )
+          .outerjoin(Pedido, MLPedidoCache.shipment_id == Pedido.shipment_id)
+          .filter(or_(Pedido.estado == None, Pedido.estado != 'armado'))
+          .distinct()
+    )
+
+
+def _q_armados(db: Session, logistic_type, inicio, fin):
+    return (
+        db.query(Pedido.shipment_id)
+          .join(MLPedidoCache, MLPedidoCache.shipment_id == Pedido.shipment_id)
+          .filter(
+              Pedido.estado == 'armado',
+              Pedido.fecha_armado.between(inicio, fin),
+              MLPedidoCache.logistic_type == logistic_type,
+              MLPedidoCache.logistic_type != 'fulfillment',
+          )
+          .distinct()
+    )
+
+
+def _q_cancelados(db: Session, inicio, fin):
+    return (
+        db.query(MLPedidoCache.shipment_id)
+          .filter(
+              MLPedidoCache.estado_ml == 'cancelled',
+              MLPedidoCache.fecha_consulta.between(inicio, fin),
+              MLPedidoCache.logistic_type != 'fulfillment',
+          )
+          .distinct()
+    )
+
+
+def _queries(db: Session, inicio, fin) -> dict:
+    return {
+        "flex_total": _q_total(db, LOGISTICAS["flex"], inicio, fin),
+        "flex_armados": _q_armados(db, LOGISTICAS["flex"], inicio, fin),
+        "colecta_total": _q_total(db, LOGISTICAS["colecta"], inicio, fin),
+        "colecta_armados": _q_armados(db, LOGISTICAS["colecta"], inicio, fin),
+        "cancelado": _q_cancelados(db, inicio, fin),
+    }
+
+
+def _a_resumen(row: DashboardContador) -> dict:
+    return {
+        "flex_total": row.flex_total or 0,
+        "flex_armados": row.flex_armados or 0,
+        "colecta_total": row.colecta_total or 0,
+        "colecta_armados": row.colecta_armados or 0,
+        "cancelados": list(row.cancelados or []),
+    }
+
+
+# --- Recálculo completo (corrige cualquier deriva) ---
+
+def recomputar_dashboard(db: Session = None) -> dict:
+    """Recalcula la ventana actual desde cero y reescribe contadores y aportes por shipment."""
+    propia = db is None
+    db = db or SessionLocal()
+    try:
+        inicio, fin = ventana_actual()
+        sets = {k: {sid for (sid,) in q.all()} for k, q in _queries(db, inicio, fin).items()}
+
+        db.query(DashboardEnvio).filter(DashboardEnvio.ventana == inicio).delete(synchronize_session=False)
+        for sid in set().union(*sets.values()):
+            db.add(DashboardEnvio(ventana=inicio, shipment_id=sid, **{k: sid in v for k, v in sets.items()}))
+
+        ahora = datetime.now(timezone.utc)
+        row = db.get(DashboardContador, inicio) or DashboardContador(ventana=inicio)
+        for k in CONTADORES:
+            setattr(row, k, len(sets[k]))
+        row.cancelados = sorted(sets["cancelado"])
+        row.recalculado_en = ahora
+        row.actualizado_en = ahora
+        db.merge(row)
+        db.commit()
+        return _a_resumen(row)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        if propia:
+            db.close()
+
+
+# --- Actualización incremental por evento (cacheado / armado / despachado) ---
+
+def _asegurar_envio(db: Session, inicio, sid: str):
+    """
+    INSERT ... ON CONFLICT DO NOTHING de la fila de aporte (todo en False), para que
+    siempre exista una fila que bloquear con FOR UPDATE antes de calcular el delta.
+    """
+    dialecto = db.get_bind().dialect.name
+    if dialecto == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialecto == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        if db.get(DashboardEnvio, (inicio, sid)) is None:
+            db.add(DashboardEnvio(ventana=inicio, shipment_id=sid))
+            db.flush()
+        return
+    db.execute(insert(DashboardEnvio.__table__)
+               .values(ventana=inicio, shipment_id=sid, flex_total=False, flex_armados=False,
+                       colecta_total=False, colecta_armados=False, cancelado=False)
+               .on_conflict_do_nothing(index_elements=["ventana", "shipment_id"]))
+
+
+def actualizar_contadores_envio(shipment_id) -> None:
+    """
+    Recalcula el aporte de UN shipment a la ventana actual (queries acotadas por
+    shipment_id, con índice) y aplica la diferencia sobre la fila de contadores
+    con un UPDATE atómico (col = col + delta), sin pisar lo que sumen otros workers.
+    La fila de aporte se crea y se bloquea antes de leer nada, así dos workers con el
+    mismo shipment no calculan el delta contra el mismo estado previo.
+    Si todavía no hay fila para la ventana, no hace nada: la crea el próximo recálculo.
+    """
+    if not shipment_id:
+        return
+    sid = str(shipment_id)
+    db = SessionLocal()
+    try:
+        inicio, fin = ventana_actual()
+        if db.get(DashboardContador, inicio) is None:
+            return
+
+        _asegurar_envio(db, inicio, sid)
+        previo = (db.query(DashboardEnvio)
+                    .filter(DashboardEnvio.ventana == inicio, DashboardEnvio.shipment_id == sid)
+                    .with_for_update()
+                    .populate_existing()
+                    .one())
+        nuevo = {
+            k: q.filter(MLPedidoCache.shipment_id == sid if k in ("flex_total", "colecta_total", "cancelado")
+                        else Pedido.shipment_id == sid).first() is not None
+            for k, q in _queries(db, inicio, fin).items()
+        }
+        viejo = {k: bool(getattr(previo, k)) for k in nuevo}
+        if nuevo == viejo:
+            # la fila en False que pudo haberse insertado no aporta nada: no hace falta guardarla
+            db.rollback()
+            return
+
+        valores = {"actualizado_en": datetime.now(timezone.utc)}
+        for k in CONTADORES:
+            delta = int(nuevo[k]) - int(viejo[k])
+            if delta:
+                col = func.coalesce(getattr(DashboardContador, k), 0) + delta
+                valores[k] = case((col < 0, 0), else_=col)
+        if nuevo["cancelado"] != viejo["cancelado"]:
+            # la lista JSON no admite un UPDATE atómico: solo en este caso se bloquea la fila
+            row = (db.query(DashboardContador)
+                     .filter(DashboardContador.ventana == inicio)
+                     .with_for_update()
+                     .first())
+            cancelados = [c for c in (row.cancelados or []) if c != sid]
+            if nuevo["cancelado"]:
+                cancelados.append(sid)
+            valores["cancelados"] = cancelados
+        db.execute(update(DashboardContador)
+                   .where(DashboardContador.ventana == inicio)
+                   .values(**valores)
+                   .execution_options(synchronize_session=False))
+
+        for k, v in nuevo.items():
+            setattr(previo, k, v)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.warning("No se pudieron actualizar contadores del dashboard para %s: %s", sid, e)
+    finally:
+        db.close()
+
+
+def leer_dashboard(db: Session) -> dict:
+    """Lectura del dashboard: una fila. Si la ventana es nueva, se recalcula una vez."""
+    inicio, _ = ventana_actual()
+    row = db.get(DashboardContador, inicio)
+    if row is None:
+        return recomputar_dashboard(db)
+    return _a_resumen(row)
@@ -0,0 +1,242 @@
+# crud/ml_items.py
+import os
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+from database.connection import SessionLocal
+from database.models import MLItem
+from http_ml import fetch_api_async
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_IMG = "https://via.placeholder.com/150"
+
+# LRU en memoria con TTL, respaldado por ml_items_cache (sobrevive reinicios)
+ITEM_CACHE_TTL = int(os.getenv("ML_ITEM_CACHE_TTL", str(6 * 3600)))   # segundos
+ITEM_CACHE_MAX = int(os.getenv("ML_ITEM_CACHE_MAX", "2000"))          # entradas (item_id, variation_id)
+# El LRU es por worker: invalidar_item solo limpia el del que recibió el webhook. Con un TTL
+# en memoria corto, los demás vuelven a mirar la tabla (donde la fila quedó vencida) enseguida.
+ITEM_CACHE_MEM_TTL = int(os.getenv("ML_ITEM_CACHE_MEM_TTL", "60"))    # segundos
+
+# Multi-get de ML: /items?ids=A,B,C admite hasta 20 ids por request
+MULTIGET_MAX = 20
+MULTIGET_ATTRS = "id,title,permalink,pictures,variations"
+
+_lru = OrderedDict()   # (item_id, variation_id) -> (expira_epoch, {"titulo", "permalink", "imagenes"})
+_lru_lock = threading.Lock()
+
+
+def _key(item_id, variation_id=None):
+    return (str(item_id), str(variation_id or ""))
+
+
+def _get_memoria(item_id, variation_id=None):
+    key = _key(item_id, variation_id)
+    with _lru_lock:
+        entry = _lru.get(key)
+        if not entry:
+            return None
+        expira, meta = entry
+        if expira < time.time():
+            del _lru[key]
+            return None
+        _lru.move_to_end(key)
+        return meta
+
+
+def _set_memoria(item_id, variation_id, meta, expira=None):
+    key = _key(item_id, variation_id)
+    with _lru_lock:
+        tope = time.time() + min(ITEM_CACHE_TTL, ITEM_CACHE_MEM_TTL)
+        _lru[key] = (min(expira, tope) if expira else tope, meta)
+        _lru.move_to_end(key)
+        while len(_lru) > ITEM_CACHE_MAX:
+            _lru.popitem(last=False)
+
+
+def imagenes_desde_item(data: dict) -> dict:
+    """
+    Arma las imágenes de un JSON /items/{id}: la lista del ítem (clave "")
+    y una por variación (clave str(variation_id)) a partir de picture_ids.
+    """
+    imagenes = {"": [
+        {"url": pic.get("url", DEFAULT_IMG), "thumbnail": pic.get("secure_url", DEFAULT_IMG)}
+        for pic in data.get("pictures", []) or []
+    ]}
+    for v in data.get("variations", []) or []:
+        if v.get("id") is None:
+            continue
+        imagenes[str(v["id"])] = imagenes_desde_picture_ids(v.get("picture_ids", []))
+    return imagenes
+
+
+def imagenes_desde_picture_ids(picture_ids) -> list:
+    return [{
+        "url": f"https://http2.mlstatic.com/D_{pid}-O.jpg",
+        "thumbnail": f"https://http2.mlstatic.com/D_{pid}-I.jpg"
+    } for pid in picture_ids or []]
+
+
+def _meta(titulo, permalink, imagenes, variation_id=None) -> dict:
+    imgs = imagenes.get(str(variation_id or "")) if imagenes else None
+    return {
+        "titulo": titulo,
+        "permalink": permalink,
+        "imagenes": imgs or [{"url": DEFAULT_IMG, "thumbnail": DEFAULT_IMG}],
+    }
+
+
+def _fila_fresca(row):
+    if not row or not row.imagenes or not row.actualizado:
+        return None
+    actualizado = row.actualizado
+    if actualizado.tzinfo is None:
+        actualizado = actualizado.replace(tzinfo=timezone.utc)
+    if datetime.now(timezone.utc) - actualizado > timedelta(seconds=ITEM_CACHE_TTL):
+        return None
+    expira = actualizado.timestamp() + ITEM_CACHE_TTL
+    return row.titulo, row.permalink, dict(row.imagenes), expira
+
+
+def _leer_db(item_ids) -> dict:
+    """item_id -> (titulo, permalink, imagenes, expira) para las filas dentro del TTL (una query)."""
+    session = SessionLocal()
+    try:
+        rows = session.query(MLItem).filter(MLItem.item_id.in_(list(item_ids))).all()
+        return {r.item_id: f for r in rows if (f := _fila_fresca(r))}
+    finally:
+        session.close()
+
+
+def _cachear_memoria(item_id, titulo, permalink, imagenes, expira=None):
+    for vid in imagenes:
+        _set_memoria(item_id, vid, _meta(titulo, permalink, imagenes, vid), expira)
+
+
+def guardar_items_db(registros):
+    """
+    Upsert en ml_items_cache de [(item_id, titulo, permalink, imagenes)] en una transacción;
+    mergea las imágenes por variación con las existentes.
+    """
+    if not registros:
+        return
+    session = SessionLocal()
+    try:
+        ids = [r[0] for r in registros]
+        existentes = {r.item_id: r for r in session.query(MLItem).filter(MLItem.item_id.in_(ids)).all()}
+        ahora = datetime.now(timezone.utc)
+        for item_id, titulo, permalink, imagenes in registros:
+            row = existentes.get(item_id)
+            if not row:
+                row = existentes[item_id] = MLItem(item_id=item_id)
+                session.add(row)
+            if titulo is not None:
+                row.titulo = titulo
+            if permalink is not None:
+                row.permalink = permalink
+            if imagenes is not None:
+                row.imagenes = {**(row.imagenes or {}), **imagenes}
+            row.actualizado = ahora
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        logger.warning("No se pudieron guardar %s items en cache: %s", len(registros), e)
+    finally:
+        session.close()
+
+
+async def precargar_items(pares):
+    """
+    Etapa de resolución de ítems para un envío/lote: recibe [(item_id, variation_id)],
+    trae de la tabla lo que esté fresco (una query) y el resto con multi-get
+    (/items?ids=..., de a MULTIGET_MAX). Deja todo en el LRU, así después
+    obtener_item_meta (imágenes, permalink, título) no sale a la red.
+    """
+    pendientes = {(str(i), str(v or "")) for i, v in pares if i}
+    pendientes = {p for p in pendientes if not _get_memoria(*p)}
+    if not pendientes:
+        return
+
+    # 1) Tabla ml_items_cache
+    frescos = await asyncio.to_thread(_leer_db, {i for i, _ in pendientes})
+    for item_id, (titulo, permalink, imagenes, expira) in frescos.items():
+        _cachear_memoria(item_id, titulo, permalink, imagenes, expira)
+    pendientes = {p for p in pendientes if not _get_memoria(*p)}
+    if not pendientes:
+        return
+
+    # 2) Multi-get a ML para los que faltan
+    ids = sorted({i for i, _ in pendientes})
+    registros = []
+    for n in range(0, len(ids), MULTIGET_MAX):
+        chunk = ids[n:n + MULTIGET_MAX]
+        try:
+            res = await fetch_api_async("/items", params={"ids": ",".join(chunk), "attributes": MULTIGET_ATTRS})
+        except Exception as e:
+            logger.warning("Multi-get de items falló (%s): %s", ",".join(chunk), e)
+            continue
+        for entry in res or []:
+            if "code" in entry and entry.get("code") != 200:
+                continue
+            data = entry.get("body", entry)
+            item_id = str(data.get("id") or "")
+            if not item_id:
+                continue
+            titulo, permalink = data.get("title"), data.get("permalink")
+            imagenes = imagenes_desde_item(data)
+            for i, vid in pendientes:
+                # Variación que no vino en el JSON del ítem → la pedimos aparte
+                if i == item_id and vid and vid not in imagenes:
+                    try:
+                        v = await fetch_api_async(f"/items/{item_id}/variations/{vid}")
+                        imagenes[vid] = imagenes_desde_picture_ids(v.get("picture_ids", []))
+                    except Exception as e:
+                        logger.warning("No se pudo traer variación %s/%s: %s", item_id, vid, e)
+            _cachear_memoria(item_id, titulo, permalink, imagenes)
+            registros.append((item_id, titulo, permalink, imagenes))
+
+    await asyncio.to_thread(guardar_items_db, registros)
+
+
+async def obtener_item_meta(item_id, variation_id=None) -> dict:
+    """
+    Título, permalink e imágenes de (item_id, variation_id).
+    Orden: LRU en memoria → ml_items_cache (si está dentro del TTL) → API de ML.
+    """
+    meta = _get_memoria(item_id, variation_id)
+    if meta:
+        return meta
+    await precargar_items([(item_id, variation_id)])
+    return _get_memoria(item_id, variation_id) or _meta(None, None, {}, variation_id)
+
+
+def invalidar_item(item_id, variation_id=None):
+    """
+    Invalida un ítem (o solo una variación) en memoria y marca la fila vencida en la tabla.
+    """
+    item_id = str(item_id)
+    with _lru_lock:
+        if variation_id is not None:
+            _lru.pop(_key(item_id, variation_id), None)
+        else:
+            for key in [k for k in _lru if k[0] == item_id]:
+                del _lru[key]
+
+    session = SessionLocal()
+    try:
+        row = session.get(MLItem, item_id)
+        if row:
+            row.actualizado = None
+            session.commit()
+    finally:
+        session.close()
+
+
+def limpiar_cache_items():
+    """Vacía el LRU en memoria (la tabla queda como está)."""
+    with _lru_lock:
+        _lru.clear()
@@ -1,14 +1,18 @@
 import asyncio
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timedelta, timezone, date
 import logging
+import threading
+import time
 
-import aiohttp  # Usado para enriquecer permalinks
 from sqlalchemy.orm import Session
-from sqlalchemy import or_, false
+from sqlalchemy import or_, and_, false, func
 from database.connection import SessionLocal
 from database.models import Pedido, WsItem, MLPedidoCache, MLItem  # ✅ agregué MLItem si usás fetch_item_permalink
 from ws.items import buscar_item_por_sku, parsear_items,obtener_todos_los_items
 from ws.auth import autenticar_desde_json
+from ws.catalogo import solicitar_refresh_catalogo, SKUS_PLACEHOLDER
+from crud.dashboard import actualizar_contadores_envio
+from crud.validadores_ml import purgar_respuestas
 from sqlalchemy.orm import Session
 from database.models import WsItem
 
@@ -36,6 +40,43 @@ def add_order_if_not_exists(detalle):
     session.commit()
     session.close()
 
+def add_orders_if_not_exist(detalles) -> int:
+    """
+    Alta mínima en lote (como hace /escanear de a uno): los shipments que ya
+    tienen filas en pedidos se saltean, el resto se inserta en una sola
+    transacción. Devuelve cuántas filas agregó.
+    """
+    filas = [(d["cliente"], item) for d in detalles for item in d["items"]]
+    if not filas:
+        return 0
+    session = SessionLocal()
+    try:
+        sids = {item["shipment_id"] for _, item in filas}
+        con_filas = {sid for (sid,) in session.query(Pedido.shipment_id)
+                                              .filter(Pedido.shipment_id.in_(sids))
+                                              .distinct()}
+        vistos = set()
+        for cliente, item in filas:
+            clave = (item["shipment_id"], item["order_id"], item["titulo"])
+            if item["shipment_id"] in con_filas or clave in vistos:
+                continue
+            vistos.add(clave)
+            session.add(Pedido(
+                order_id=item["order_id"],
+                shipment_id=item["shipment_id"],
+                cliente=cliente,
+                titulo=item["titulo"],
+                cantidad=item["cantidad"],
+                estado="pendiente"
+            ))
+        session.commit()
+        return len(vistos)
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
 def marcar_envio_armado(shipment_id, usuario):
     session = SessionLocal()
     ahora = datetime.now()
@@ -109,6 +150,7 @@ def marcar_envio_armado(shipment_id, usuario):
             afectados += 1
 
         session.commit()
+        actualizar_contadores_envio(sid)
         return afectados > 0
     except Exception as e:
         session.rollback()
@@ -151,6 +193,7 @@ def marcar_pedido_despachado(db: Session, shipment_id, logistica, tipo_envio, us
         pedido.usuario_despacho = usuario
 
     db.commit()
+    actualizar_contadores_envio(shipment_id)
     print(f"✅ Shipment {shipment_id} marcado como despachado por {usuario}")
     return True
 
@@ -160,10 +203,13 @@ def get_estado_envio(shipment_id):
     session.close()
     return pedido[0] if pedido else None
 
-def get_all_pedidos(order_id=None, shipment_id=None, date_from=None, date_to=None, logistica=None):
-    session = SessionLocal()
-    query = session.query(Pedido)
+def _fin_de_dia(d):
+    """Límite superior exclusivo para filtrar un día completo."""
+    return datetime.combine(d, datetime.min.time()) + timedelta(days=1) if isinstance(d, date) and not isinstance(d, datetime) else d
 
+
+def _filtrar_pedidos(query, order_id=None, shipment_id=None, date_from=None, date_to=None, logistica=None,
+                     estado=None, despacho_desde=None, despacho_hasta=None, armado_desde=None, armado_hasta=None):
     if order_id:
         query = query.filter(Pedido.order_id.ilike(f"%{order_id}%"))
     if shipment_id:
@@ -174,11 +220,22 @@ def get_all_pedidos(order_id=None, shipment_id=None, date_from=None, date_to=Non
         query = query.filter((Pedido.fecha_armado <= date_to) | (Pedido.fecha_despacho <= date_to))
     if logistica:
         query = query.filter(Pedido.logistica == logistica)
-
-    rows = query.all()
-    session.close()
-
-    return [{
+    if estado and estado != "Todos":
+        query = query.filter(Pedido.estado == estado.lower())
+    # Despacho: como en el historial de siempre, los que aún no se despacharon no se excluyen
+    if despacho_desde:
+        query = query.filter(or_(Pedido.fecha_despacho.is_(None), Pedido.fecha_despacho >= despacho_desde))
+    if despacho_hasta:
+        query = query.filter(or_(Pedido.fecha_despacho.is_(None), Pedido.fecha_despacho < _fin_de_dia(despacho_hasta)))
+    if armado_desde:
+        query = query.filter(Pedido.fecha_armado >= armado_desde)
+    if armado_hasta:
+        query = query.filter(Pedido.fecha_armado < _fin_de_dia(armado_hasta))
+    return query
+
+
+def _pedido_a_dict(r):
+    return {
         "order_id": r.order_id,
         "cliente": r.cliente,
         "titulo": r.titulo,
@@ -191,7 +248,127 @@ def get_all_pedidos(order_id=None, shipment_id=None, date_from=None, date_to=Non
         "tipo_envio": r.tipo_envio,
         "usuario_armado": r.usuario_armado,
         "usuario_despacho": r.usuario_despacho
-    } for r in rows]
+    }
+
+
+def _cursor_de(r) -> str:
+    return f"{r.fecha_despacho.isoformat() if r.fecha_despacho else ''}|{r.id}"
+
+
+def _parse_cursor(cursor: str):
+    fecha, _, pid = (cursor or "").rpartition("|")
+    return (datetime.fromisoformat(fecha) if fecha else None), int(pid)
+
+
+def _keyset(query, cursor, hacia_atras=False):
+    """
+    Orden del historial: fecha_despacho DESC (sin despachar al final), id DESC.
+    Filtra lo que viene después (o antes, si hacia_atras) del cursor "fecha|id".
+    """
+    if cursor:
+        fecha, pid = _parse_cursor(cursor)
+        if not hacia_atras:
+            if fecha is None:
+                cond = and_(Pedido.fecha_despacho.is_(None), Pedido.id < pid)
+            else:
+                cond = or_(Pedido.fecha_despacho < fecha,
+                           and_(Pedido.fecha_despacho == fecha, Pedido.id < pid),
+                           Pedido.fecha_despacho.is_(None))
+        else:
+            if fecha is None:
+                cond = or_(Pedido.fecha_despacho.isnot(None),
+                           and_(Pedido.fecha_despacho.is_(None), Pedido.id > pid))
+            else:
+                cond = or_(Pedido.fecha_despacho > fecha,
+                           and_(Pedido.fecha_despacho == fecha, Pedido.id > pid))
+        query = query.filter(cond)
+    if hacia_atras:
+        return query.order_by(Pedido.fecha_despacho.asc().nullsfirst(), Pedido.id.asc())
+    return query.order_by(Pedido.fecha_despacho.desc().nullslast(), Pedido.id.desc())
+
+
+def get_all_pedidos(order_id=None, shipment_id=None, date_from=None, date_to=None, logistica=None,
+                    estado=None, despacho_desde=None, despacho_hasta=None, armado_desde=None, armado_hasta=None):
+    session = SessionLocal()
+    query = _filtrar_pedidos(
+        session.query(Pedido), order_id=order_id, shipment_id=shipment_id, date_from=date_from,
+        date_to=date_to, logistica=logistica, estado=estado, despacho_desde=despacho_desde,
+        despacho_hasta=despacho_hasta, armado_desde=armado_desde, armado_hasta=armado_hasta,
+    )
+
+    rows = query.all()
+    session.close()
+
+    return [_pedido_a_dict(r) for r in rows]
+
+
+def iterar_pedidos(chunk=1000, **filtros):
+    """
+    Recorre los pedidos filtrados con un cursor del lado del servidor
+    (stream_results + yield_per): memoria constante sin importar el rango.
+    """
+    session = SessionLocal()
+    try:
+        query = (_filtrar_pedidos(session.query(Pedido), **filtros)
+                   .order_by(Pedido.id)
+                   .execution_options(stream_results=True)
+                   .yield_per(chunk))
+        for r in query:
+            yield _pedido_a_dict(r)
+    finally:
+        session.close()
+
+
+# COUNT del historial cacheado por combinación de filtros (la paginación no lo necesita exacto al segundo)
+CONTEO_TTL = 30
+_conteo_cache = {}
+_conteo_lock = threading.Lock()
+
+
+def contar_pedidos(**filtros) -> int:
+    clave = tuple(sorted((k, str(v)) for k, v in filtros.items() if v))
+    ahora = time.time()
+    with _conteo_lock:
+        hit = _conteo_cache.get(clave)
+        if hit and hit[0] > ahora:
+            return hit[1]
+    session = SessionLocal()
+    try:
+        total = _filtrar_pedidos(session.query(func.count(Pedido.id)), **filtros).scalar() or 0
+    finally:
+        session.close()
+    with _conteo_lock:
+        if len(_conteo_cache) > 500:
+            _conteo_cache.clear()
+        _conteo_cache[clave] = (ahora + CONTEO_TTL, total)
+    return total
+
+
+def get_pedidos_pagina(limite=20, cursor=None, hacia_atras=False, offset=None, **filtros):
+    """
+    Una página del historial con keyset sobre (fecha_despacho, id).
+    Devuelve (pedidos, cursor_siguiente, cursor_anterior); cada cursor es None si no hay más.
+    `offset` solo se usa como compatibilidad para links viejos con ?page=N sin cursor.
+    """
+    session = SessionLocal()
+    try:
+        query = _keyset(_filtrar_pedidos(session.query(Pedido), **filtros), cursor, hacia_atras)
+        if offset:
+            query = query.offset(offset)
+        rows = query.limit(limite + 1).all()
+    finally:
+        session.close()
+
+    hay_mas = len(rows) > limite
+    rows = rows[:limite]
+    if hacia_atras:
+        rows.reverse()
+        siguiente = _cursor_de(rows[-1]) if rows else None
+        anterior = _cursor_de(rows[0]) if rows and hay_mas else None
+    else:
+        siguiente = _cursor_de(rows[-1]) if rows and hay_mas else None
+        anterior = _cursor_de(rows[0]) if rows and (cursor or offset) else None
+    return [_pedido_a_dict(r) for r in rows], siguiente, anterior
 
 
 def limpiar_cache_antiguo(db: Session, dias: int = 30):
@@ -199,6 +376,7 @@ def limpiar_cache_antiguo(db: Session, dias: int = 30):
     limite = datetime.now() - timedelta(days=dias)
     db.query(MLPedidoCache).filter(MLPedidoCache.fecha_consulta < limite).delete()
     db.commit()
+    purgar_respuestas(dias)
 
 
 def marcar_pedido_con_feedback(order_id: int, db: Session):
@@ -215,63 +393,45 @@ def buscar_item_cache_por_sku(db: Session, sku: str):
     return db.query(WsItem).filter(WsItem.item_code == sku).first()
 
 
-async def enriquecer_items_ws(items: list, db: Session):
-    sku_cache = {}
-    skus_faltantes = set()
+def buscar_items_cache_por_skus(db: Session, skus) -> dict:
+    """sku -> item_vendorCode para todo el lote, en una sola query (usa el índice de item_code)."""
+    skus = {s for s in skus if s}
+    if not skus:
+        return {}
+    rows = (db.query(WsItem.item_code, WsItem.item_vendorCode)
+              .filter(WsItem.item_code.in_(skus))
+              .all())
+    return {code: vendor for code, vendor in rows}
 
-    # 1. Buscar en caché local
-    for item in items:
-        sku = item.get("sku")
-        if not sku:
-            continue
-        info = buscar_item_cache_por_sku(db, sku)
-        if info:
-            sku_cache[sku] = {
-                 "item_vendorCode": info.item_vendorCode
-            }
-        else:
-            skus_faltantes.add(sku)
 
-    # 2. Si hay faltantes, consultar el WS UNA vez
-    if skus_faltantes:
-        print(f"🔍 Buscando {len(skus_faltantes)} SKUs faltantes desde Web Service...")
-        token = await asyncio.to_thread(autenticar_desde_json)
-        xml = await asyncio.to_thread(obtener_todos_los_items, token)
-        ws_items = await asyncio.to_thread(parsear_items, xml)
-
-        nuevos_ws_items = []
-
-        for ws_data in ws_items:
-            item_code = ws_data["item_code"]
-            if item_code in skus_faltantes:
-                sku_cache[item_code] = {
-                    "item_vendorCode": ws_data["item_vendorCode"]
-                }
+def buscar_cache_por_shipments(db: Session, shipment_ids) -> dict:
+    """shipment_id -> [MLPedidoCache] para todo el lote, en una sola query."""
+    sids = {str(s) for s in shipment_ids if s}
+    if not sids:
+        return {}
+    por_sid = {}
+    for rec in db.query(MLPedidoCache).filter(MLPedidoCache.shipment_id.in_(sids)).all():
+        por_sid.setdefault(rec.shipment_id, []).append(rec)
+    return por_sid
 
-                # Crear objeto para guardar en DB
-                # ✅ CORRECTO
-            nuevos_ws_items.append(WsItem(
-            item_id=ws_data["item_id"],
-            item_code=ws_data["item_code"],
-            item_vendorCode=ws_data["item_vendorCode"]  # ✅ corregido
-            ))
 
+async def enriquecer_items_ws(items: list, db: Session):
+    # 1. Todo el lote contra el caché local en una query
+    skus = {item.get("sku") for item in items if item.get("sku") and item.get("sku") not in SKUS_PLACEHOLDER}
+    sku_cache = buscar_items_cache_por_skus(db, skus)
 
-        # Guardar nuevos ítems en la base de datos
-        if nuevos_ws_items:
-            db.bulk_save_objects(nuevos_ws_items)
-            db.commit()
-            print(f"✅ {len(nuevos_ws_items)} ítems nuevos agregados al cache.")
+    # 2. Los faltantes NO bajan el catálogo acá: se encola un refresh en background
+    skus_faltantes = skus - set(sku_cache)
+    if skus_faltantes:
+        print(f"🔍 {len(skus_faltantes)} SKUs sin código de proveedor, se encola refresh del catálogo WS")
+        solicitar_refresh_catalogo(skus_faltantes)
 
     # 3. Enriquecer los ítems con los datos ya en memoria
     for item in items:
         sku = item.get("sku")
-        if not sku:
+        if not sku or sku not in sku_cache:
             continue
-        info = sku_cache.get(sku)
-        if info:
-            item["codigo_proveedor"] = info["item_vendorCode"]
-            item["item_vendorCode"] = info["item_vendorCode"]
-            item["codigo_alfa"] = info["item_vendorCode"]
-
-
+        vendor = sku_cache[sku]
+        item["codigo_proveedor"] = vendor
+        item["item_vendorCode"] = vendor
+        item["codigo_alfa"] = vendor
@@ -0,0 +1,51 @@
+# crud/validadores_ml.py
+from datetime import datetime, timedelta, timezone
+
+from database.connection import SessionLocal
+from database.models import MLRespuesta
+
+
+def leer_respuesta(clave: str):
+    """(etag, last_modified, cuerpo) guardados para la clave, o None."""
+    session = SessionLocal()
+    try:
+        row = session.get(MLRespuesta, clave)
+        return (row.etag, row.last_modified, row.cuerpo) if row else None
+    finally:
+        session.close()
+
+
+def guardar_respuesta(clave: str, etag, last_modified, cuerpo) -> None:
+    session = SessionLocal()
+    try:
+        session.merge(MLRespuesta(clave=clave, etag=etag, last_modified=last_modified,
+                                  cuerpo=cuerpo, actualizado=datetime.now(timezone.utc)))
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def tocar_respuesta(clave: str) -> None:
+    """ML respondió 304: la respuesta guardada sigue vigente."""
+    session = SessionLocal()
+    try:
+        (session.query(MLRespuesta)
+                .filter(MLRespuesta.clave == clave)
+                .update({MLRespuesta.actualizado: datetime.now(timezone.utc)}, synchronize_session=False))
+        session.commit()
+    finally:
+        session.close()
+
+
+def purgar_respuestas(dias: int = 30) -> int:
+    session = SessionLocal()
+    try:
+        limite = datetime.now(timezone.utc) - timedelta(days=dias)
+        n = session.query(MLRespuesta).filter(MLRespuesta.actualizado < limite).delete(synchronize_session=False)
+        session.commit()
+        return n
+    finally:
+        session.close()
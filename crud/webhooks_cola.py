@@ -0,0 +1,158 @@
+# crud/webhooks_cola.py
+import os
+import random
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import func
+
+from database.connection import SessionLocal
+from database.models import WebhookEvento
+
+MAX_INTENTOS = int(os.getenv("WEBHOOK_MAX_INTENTOS", "6"))
+BACKOFF_BASE = float(os.getenv("WEBHOOK_BACKOFF_BASE", "5"))      # segundos
+BACKOFF_MAX = float(os.getenv("WEBHOOK_BACKOFF_MAX", "900"))
+TOMADO_VENCE = int(os.getenv("WEBHOOK_TOMADO_VENCE", "300"))      # un lote "procesando" más viejo se reintenta
+RETENCION_DIAS = int(os.getenv("WEBHOOK_RETENCION_DIAS", "3"))
+
+
+def _ahora():
+    return datetime.now(timezone.utc)
+
+
+def _utc(dt):
+    if dt is None:
+        return None
+    return dt.replace(tzinfo=timezone.utc) if dt.tzinfo is None else dt
+
+
+def encolar_evento(topic: str, resource: str) -> bool:
+    """
+    Agrega la notificación a la cola. Si ya hay una pendiente para el mismo
+    resource (ML re-entrega seguido), no se duplica. Devuelve True si la insertó.
+    """
+    session = SessionLocal()
+    try:
+        existe = (session.query(WebhookEvento.id)
+                         .filter(WebhookEvento.resource == resource,
+                                 WebhookEvento.estado == "pendiente")
+                         .first())
+        if existe:
+            return False
+        session.add(WebhookEvento(topic=topic, resource=resource))
+        session.commit()
+        return True
+    finally:
+        session.close()
+
+
+def tomar_lote(limite: int = 20) -> list:
+    """
+    Reserva hasta `limite` eventos listos (pendientes con proximo_intento vencido o
+    "procesando" abandonados; retomar uno suma un intento y pasado MAX_INTENTOS queda
+    en 'error'). En Postgres usa FOR UPDATE SKIP LOCKED para que varios
+    workers/procesos no tomen el mismo. Devuelve [(id, topic, resource, intentos)].
+    """
+    session = SessionLocal()
+    try:
+        ahora = _ahora()
+        query = (session.query(WebhookEvento)
+                        .filter(
+                            ((WebhookEvento.estado == "pendiente") & (WebhookEvento.proximo_intento <= ahora))
+                            | ((WebhookEvento.estado == "procesando")
+                               & (WebhookEvento.tomado_en < ahora - timedelta(seconds=TOMADO_VENCE)))
+                        )
+                        .order_by(WebhookEvento.id)
+                        .limit(limite))
+        if session.get_bind().dialect.name == "postgresql":
+            query = query.with_for_update(skip_locked=True)
+        tomados = []
+        for ev in query.all():
+            # Retomar un "procesando" abandonado cuenta como intento (el worker murió o se colgó)
+            intentos = (ev.intentos or 0) + (1 if ev.estado == "procesando" else 0)
+            cambios = {WebhookEvento.estado: "procesando", WebhookEvento.tomado_en: ahora,
+                       WebhookEvento.intentos: intentos}
+            if intentos >= MAX_INTENTOS:
+                cambios = {WebhookEvento.estado: "error", WebhookEvento.intentos: intentos,
+                           WebhookEvento.procesado_en: ahora,
+                           WebhookEvento.ultimo_error: "procesamiento abandonado demasiadas veces"}
+            # Update condicional: si otro proceso lo tomó entre el SELECT y acá, rowcount = 0
+            previo = WebhookEvento.tomado_en.is_(None) if ev.tomado_en is None else WebhookEvento.tomado_en == ev.tomado_en
+            n = (session.query(WebhookEvento)
+                        .filter(WebhookEvento.id == ev.id, WebhookEvento.estado == ev.estado, previo)
+                        .update(cambios, synchronize_session=False))
+            if n and intentos < MAX_INTENTOS:
+                tomados.append((ev.id, ev.topic, ev.resource, intentos))
+        session.commit()
+        return tomados
+    finally:
+        session.close()
+
+
+def marcar_ok(ids) -> None:
+    if not ids:
+        return
+    session = SessionLocal()
+    try:
+        (session.query(WebhookEvento)
+                .filter(WebhookEvento.id.in_(list(ids)))
+                .update({WebhookEvento.estado: "ok", WebhookEvento.procesado_en: _ahora(),
+                         WebhookEvento.ultimo_error: None}, synchronize_session=False))
+        session.commit()
+    finally:
+        session.close()
+
+
+def marcar_fallido(ids, error: str) -> None:
+    """Reprograma con backoff exponencial + jitter; pasado MAX_INTENTOS queda en 'error'."""
+    if not ids:
+        return
+    session = SessionLocal()
+    try:
+        for ev in session.query(WebhookEvento).filter(WebhookEvento.id.in_(list(ids))).all():
+            ev.intentos = (ev.intentos or 0) + 1
+            ev.ultimo_error = (error or "")[:1000]
+            if ev.intentos >= MAX_INTENTOS:
+                ev.estado = "error"
+                ev.procesado_en = _ahora()
+            else:
+                espera = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (ev.intentos - 1))
+                ev.estado = "pendiente"
+                ev.proximo_intento = _ahora() + timedelta(seconds=espera * random.uniform(0.5, 1.0))
+        session.commit()
+    finally:
+        session.close()
+
+
+def purgar_procesados() -> int:
+    """Borra eventos 'ok' más viejos que RETENCION_DIAS."""
+    session = SessionLocal()
+    try:
+        limite = _ahora() - timedelta(days=RETENCION_DIAS)
+        n = (session.query(WebhookEvento)
+                    .filter(WebhookEvento.estado == "ok", WebhookEvento.procesado_en < limite)
+                    .delete(synchronize_session=False))
+        session.commit()
+        return n
+    finally:
+        session.close()
+
+
+def estadisticas_cola() -> dict:
+    """Profundidad por estado y lag (segundos desde el pendiente más viejo)."""
+    session = SessionLocal()
+    try:
+        por_estado = dict(session.query(WebhookEvento.estado, func.count(WebhookEvento.id))
+                                 .group_by(WebhookEvento.estado).all())
+        mas_viejo = (session.query(func.min(WebhookEvento.recibido_en))
+                            .filter(WebhookEvento.estado.in_(["pendiente", "procesando"]))
+                            .scalar())
+    finally:
+        session.close()
+    lag = (_ahora() - _utc(mas_viejo)).total_seconds() if mas_viejo else 0
+    return {
+        "pendientes": por_estado.get("pendiente", 0),
+        "procesando": por_estado.get("procesando", 0),
+        "error": por_estado.get("error", 0),
+        "ok": por_estado.get("ok", 0),
+        "lag_segundos": round(lag, 1),
+    }
@@ -1,19 +1,95 @@
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
 from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
 import os
+import threading
+import time
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///pedidos.db")
 
-url = make_url(DATABASE_URL)
-connect_args = {"check_same_thread": False} if url.drivername.startswith("sqlite") else {}
+# Pool de conexiones (solo aplica a motores con QueuePool, p.ej. Postgres)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))       # segundos esperando una conexión libre
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))       # segundos; evita conexiones cortadas por el server
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "30000"))   # Postgres; 0 = sin límite
 
-engine = create_engine(DATABASE_URL, connect_args=connect_args)
+_espera_lock = threading.Lock()
+_espera = {"n": 0, "total": 0.0, "max": 0.0, "ultima": 0.0}
+
+
+class _PoolMedido(QueuePool):
+    """QueuePool que registra cuánto se esperó para obtener cada conexión."""
+
+    def _do_get(self):
+        t0 = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            dt = time.perf_counter() - t0
+            with _espera_lock:
+                _espera["n"] += 1
+                _espera["total"] += dt
+                _espera["max"] = max(_espera["max"], dt)
+                _espera["ultima"] = dt
+
+
+def crear_engine(database_url: str = DATABASE_URL):
+    """
+    Único lugar donde se crea un Engine: pool configurable por env y, en Postgres,
+    statement_timeout por conexión para que una query colgada no retenga el pool.
+    """
+    url = make_url(database_url)
+    if url.drivername.startswith("sqlite"):
+        return create_engine(database_url, connect_args={"check_same_thread": False},
+                             pool_pre_ping=DB_POOL_PRE_PING)
+
+    kwargs = {}
+    if url.drivername.startswith("postgresql") and DB_STATEMENT_TIMEOUT_MS > 0:
+        kwargs["connect_args"] = {"options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"}
+    return create_engine(
+        database_url,
+        poolclass=_PoolMedido,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+        **kwargs,
+    )
+
+
+engine = crear_engine()
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
 
+def estadisticas_pool() -> dict:
+    """Estado del pool: conexiones en uso, overflow y tiempos de espera para obtener una."""
+    pool = engine.pool
+    stats = {"clase": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update({
+            "tamano": pool.size(),
+            "en_uso": pool.checkedout(),
+            "libres": pool.checkedin(),
+            "overflow": max(0, pool.overflow()),
+            "max_overflow": DB_MAX_OVERFLOW,
+        })
+    with _espera_lock:
+        n = _espera["n"]
+        stats.update({
+            "esperas": n,
+            "espera_prom_ms": round(_espera["total"] / n * 1000, 2) if n else 0.0,
+            "espera_max_ms": round(_espera["max"] * 1000, 2),
+            "espera_ultima_ms": round(_espera["ultima"] * 1000, 2),
+        })
+    return stats
+
+
 def get_db():
     db = SessionLocal()
     try:
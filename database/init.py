@@ -1,12 +1,16 @@
-import os
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import logging
+from database.connection import engine, SessionLocal  # un único engine/pool para toda la app
 from database.models import Base
+from database.migraciones import aplicar_migraciones, indices_faltantes
 
-DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///pedidos.db")  # fallback a SQLite si no hay variable
-
-engine = create_engine(DATABASE_URL, echo=False)
-SessionLocal = sessionmaker(bind=engine)
+logger = logging.getLogger(__name__)
 
 def init_db():
     Base.metadata.create_all(bind=engine)
+    aplicar_migraciones(engine)
+
+    # Chequeo de arranque: avisar si falta algún índice de los que usan las queries calientes
+    faltan = indices_faltantes(engine)
+    if faltan:
+        logger.warning("Faltan índices en la base: %s", ", ".join(faltan))
+    return faltan
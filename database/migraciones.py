@@ -0,0 +1,101 @@
+# database/migraciones.py
+"""
+Migraciones versionadas del esquema (SQLite y Postgres).
+
+create_all solo crea tablas nuevas; todo cambio sobre tablas existentes
+(columnas, índices) se agrega acá como una migración numerada. Cada una es
+idempotente y se registra en schema_version al aplicarse.
+"""
+import logging
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+
+from database.models import Base, MLItem, WsItem, Pedido, MLPedidoCache, SchemaVersion
+
+logger = logging.getLogger(__name__)
+
+# Clave del advisory lock de Postgres: un solo worker migra a la vez
+PG_LOCK_KEY = 72610013
+
+
+def _agregar_columna(conn, columna):
+    tabla = columna.table.name
+    existentes = {c["name"] for c in inspect(conn).get_columns(tabla)}
+    if columna.name in existentes:
+        return
+    tipo = columna.type.compile(dialect=conn.dialect)
+    conn.execute(text(f'ALTER TABLE {tabla} ADD COLUMN "{columna.name}" {tipo}'))
+
+
+def _crear_indices(conn, tabla, nombres=None):
+    for idx in tabla.indexes:
+        if nombres is None or idx.name in nombres:
+            idx.create(bind=conn, checkfirst=True)
+
+
+def _m1_ml_items_titulo_imagenes(conn):
+    _agregar_columna(conn, MLItem.__table__.c.titulo)
+    _agregar_columna(conn, MLItem.__table__.c.imagenes)
+
+
+def _m2_ws_items_item_code(conn):
+    _crear_indices(conn, WsItem.__table__)
+
+
+def _m3_indices_pedidos_y_cache(conn):
+    _crear_indices(conn, Pedido.__table__)
+    _crear_indices(conn, MLPedidoCache.__table__)
+
+
+def _m4_ml_cache_validado_en(conn):
+    _agregar_columna(conn, MLPedidoCache.__table__.c.validado_en)
+
+
+def _m5_indice_historial_desc(conn):
+    # El de la migración 3 era ascendente y no sirve para el orden DESC NULLS LAST del historial
+    conn.execute(text("DROP INDEX IF EXISTS ix_pedidos_fecha_despacho_id"))
+    _crear_indices(conn, Pedido.__table__, {"ix_pedidos_fecha_despacho_desc_id"})
+
+
+MIGRACIONES = [
+    (1, "ml_items_cache: columnas titulo e imagenes", _m1_ml_items_titulo_imagenes),
+    (2, "ws_items_cache: índice item_code", _m2_ws_items_item_code),
+    (3, "pedidos / ml_pedidos_cache: índices compuestos", _m3_indices_pedidos_y_cache),
+    (4, "ml_pedidos_cache: columna validado_en", _m4_ml_cache_validado_en),
+    (5, "pedidos: índice del historial en orden DESC NULLS LAST", _m5_indice_historial_desc),
+]
+
+
+def aplicar_migraciones(engine) -> list:
+    """Aplica en orden las migraciones pendientes. Devuelve las versiones aplicadas."""
+    aplicadas = []
+    with engine.begin() as conn:
+        if conn.dialect.name == "postgresql":
+            conn.execute(text("SELECT pg_advisory_xact_lock(:k)"), {"k": PG_LOCK_KEY})
+        SchemaVersion.__table__.create(bind=conn, checkfirst=True)
+        hechas = {v for (v,) in conn.execute(SchemaVersion.__table__.select().with_only_columns(SchemaVersion.version))}
+        for version, descripcion, fn in MIGRACIONES:
+            if version in hechas:
+                continue
+            fn(conn)
+            conn.execute(SchemaVersion.__table__.insert().values(
+                version=version, descripcion=descripcion, aplicada_en=datetime.utcnow()
+            ))
+            aplicadas.append(version)
+            print(f"🛠️ Migración {version} aplicada: {descripcion}")
+    return aplicadas
+
+
+def indices_faltantes(engine) -> list:
+    """Índices declarados en los modelos que no existen en la base ("tabla.indice")."""
+    insp = inspect(engine)
+    faltan = []
+    for tabla in Base.metadata.sorted_tables:
+        if not insp.has_table(tabla.name):
+            continue
+        existentes = {i["name"] for i in insp.get_indexes(tabla.name)}
+        for idx in tabla.indexes:
+            if idx.name not in existentes:
+                faltan.append(f"{tabla.name}.{idx.name}")
+    return faltan
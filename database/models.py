@@ -1,10 +1,8 @@
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, UniqueConstraint, Boolean, func, JSON
-from sqlalchemy.orm import declarative_base, sessionmaker
-from datetime import datetime
+from sqlalchemy import Column, Integer, String, Text, DateTime, UniqueConstraint, Boolean, func, JSON, Index
+from sqlalchemy.orm import declarative_base
+from datetime import datetime, timezone
 
 Base = declarative_base()
-engine = create_engine("sqlite:///pedidos.db", echo=False)
-Session = sessionmaker(bind=engine)
 
 class Pedido(Base):
     __tablename__ = "pedidos"
@@ -22,6 +20,23 @@ class Pedido(Base):
     usuario_armado = Column(String(100), nullable=True)
     usuario_despacho = Column(String(100), nullable=True)
 
+    __table_args__ = (
+        # get_estado_envio / marcar_envio_armado / marcar_pedido_despachado / joins del dashboard
+        Index("ix_pedidos_shipment_estado", "shipment_id", "estado"),
+        # upsert por (order_id, shipment_id) en marcar_envio_armado y add_order_if_not_exists
+        Index("ix_pedidos_order_shipment", "order_id", "shipment_id"),
+        # armados del dashboard: estado='armado' AND fecha_armado BETWEEN ...
+        Index("ix_pedidos_estado_fecha_armado", "estado", "fecha_armado"),
+    )
+
+
+# historial: keyset con ORDER BY fecha_despacho DESC NULLS LAST, id DESC (mismo orden que _keyset;
+# la página anterior lo recorre al revés). SQLite no acepta NULLS LAST en un índice, pero ahí
+# los NULL ya ordenan como el menor valor, así que DESC los deja al final igual.
+Index("ix_pedidos_fecha_despacho_desc_id",
+      Pedido.fecha_despacho.desc().nullslast(), Pedido.id.desc()).ddl_if(dialect="postgresql")
+Index("ix_pedidos_fecha_despacho_desc_id",
+      Pedido.fecha_despacho.desc(), Pedido.id.desc()).ddl_if(dialect="sqlite")
 
 class Usuario(Base):
     __tablename__ = "usuarios"
@@ -38,7 +53,7 @@ class WsItem(Base):
     __tablename__ = "ws_items_cache"
 
     item_id = Column(String, primary_key=True)
-    item_code = Column(String)
+    item_code = Column(String, index=True)
     item_vendorCode = Column(String)  # <== ATENCIÓN a la C mayúscula
     actualizado = Column(DateTime, default=datetime.utcnow)
 
@@ -54,6 +69,17 @@ class MLPedidoCache(Base):
     fecha_consulta = Column(DateTime(timezone=True), server_default=func.now())
     tiene_devolucion = Column(Boolean, default=False) 
     logistic_type = Column(String, nullable=True, index=True)
+    # Última vez que ML confirmó (304) que el envío no cambió; la frescura es max(esto, fecha_consulta)
+    validado_en = Column(DateTime(timezone=True), nullable=True)
+
+    __table_args__ = (
+        # totales flex/colecta del dashboard: logistic_type + ventana de fecha_consulta
+        Index("ix_ml_cache_logistic_fecha", "logistic_type", "fecha_consulta"),
+        # cancelados del dashboard
+        Index("ix_ml_cache_estado_fecha", "estado_ml", "fecha_consulta"),
+        # limpiar_cache_antiguo
+        Index("ix_ml_cache_fecha_consulta", "fecha_consulta"),
+    )
 
 class MLItem(Base):
     __tablename__ = "ml_items_cache"
@@ -61,3 +87,67 @@ class MLItem(Base):
     item_id = Column(String, primary_key=True)
     permalink = Column(String)
     actualizado = Column(DateTime)
+    titulo = Column(Text, nullable=True)
+    imagenes = Column(JSON, nullable=True)  # {"": [...], "<variation_id>": [...]}
+
+class SchemaVersion(Base):
+    __tablename__ = "schema_version"
+
+    version = Column(Integer, primary_key=True)
+    descripcion = Column(String(255))
+    aplicada_en = Column(DateTime, default=datetime.utcnow)
+
+class DashboardContador(Base):
+    """Contadores del dashboard por ventana (ayer 14:00 → hoy 14:00), mantenidos incrementalmente."""
+    __tablename__ = "dashboard_contadores"
+
+    ventana = Column(DateTime(timezone=True), primary_key=True)  # inicio de la ventana
+    flex_total = Column(Integer, default=0)
+    flex_armados = Column(Integer, default=0)
+    colecta_total = Column(Integer, default=0)
+    colecta_armados = Column(Integer, default=0)
+    cancelados = Column(JSON, default=list)
+    recalculado_en = Column(DateTime(timezone=True), nullable=True)
+    actualizado_en = Column(DateTime(timezone=True), nullable=True)
+
+class DashboardEnvio(Base):
+    """Aporte de cada shipment a los contadores de una ventana (para aplicar deltas exactos)."""
+    __tablename__ = "dashboard_envios"
+
+    ventana = Column(DateTime(timezone=True), primary_key=True)
+    shipment_id = Column(String, primary_key=True)
+    flex_total = Column(Boolean, default=False)
+    flex_armados = Column(Boolean, default=False)
+    colecta_total = Column(Boolean, default=False)
+    colecta_armados = Column(Boolean, default=False)
+    cancelado = Column(Boolean, default=False)
+
+class WebhookEvento(Base):
+    """Cola durable de notificaciones de ML: el webhook solo inserta, los workers procesan."""
+    __tablename__ = "webhook_cola"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    topic = Column(String(50))
+    resource = Column(String(255), nullable=False)
+    estado = Column(String(20), default="pendiente")   # pendiente | procesando | ok | error
+    intentos = Column(Integer, default=0)
+    recibido_en = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+    proximo_intento = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+    tomado_en = Column(DateTime(timezone=True), nullable=True)
+    procesado_en = Column(DateTime(timezone=True), nullable=True)
+    ultimo_error = Column(Text, nullable=True)
+
+    __table_args__ = (
+        Index("ix_webhook_cola_estado_proximo", "estado", "proximo_intento"),
+        Index("ix_webhook_cola_resource_estado", "resource", "estado"),
+    )
+
+class MLRespuesta(Base):
+    """Último cuerpo de un GET a ML con sus validadores, para revalidar con GET condicional."""
+    __tablename__ = "ml_http_cache"
+
+    clave = Column(String(500), primary_key=True)   # path + query ordenada
+    etag = Column(String(255), nullable=True)
+    last_modified = Column(String(64), nullable=True)
+    cuerpo = Column(JSON, nullable=True)
+    actualizado = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc), index=True)
@@ -0,0 +1,136 @@
+# enriquecimiento.py
+"""
+Servicio de enriquecimiento en background (reemplaza al asyncio.run por tarea).
+
+Corre en el event loop de la app con una cola acotada y pocos workers, así una
+ráfaga de escaneos no levanta un loop ni una sesión por request. Un shipment
+que ya está en cola o en proceso no se vuelve a encolar (dedupe en memoria, por
+proceso), y uno cuya fila en ml_pedidos_cache es más nueva que ENRIQUECER_EDAD_MIN
+segundos se saltea: la edad sale de la base, así vale para todos los workers y
+sobrevive a un reinicio.
+"""
+import os
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+
+from api_ml import get_order_details, _frescura, _esta_enriquecido
+from database.connection import SessionLocal
+from database.models import MLPedidoCache
+
+logger = logging.getLogger(__name__)
+
+ENRIQUECER_WORKERS = int(os.getenv("ENRIQUECER_WORKERS", "2"))
+ENRIQUECER_MAX_COLA = int(os.getenv("ENRIQUECER_MAX_COLA", "200"))
+ENRIQUECER_EDAD_MIN = int(os.getenv("ENRIQUECER_EDAD_MIN", "600"))   # segundos
+
+_cola = None            # asyncio.Queue creada en iniciar_enriquecedor (loop de la app)
+_en_curso = set()       # shipments en cola o procesándose
+_workers = []
+_stats = {"encolados": 0, "duplicados": 0, "recientes": 0, "descartados": 0, "ok": 0, "errores": 0}
+
+
+def _reciente(shipment_id: str) -> bool:
+    """True si todas las filas del shipment están enriquecidas y son más nuevas que ENRIQUECER_EDAD_MIN."""
+    session = SessionLocal()
+    try:
+        recs = session.query(MLPedidoCache).filter(MLPedidoCache.shipment_id == shipment_id).all()
+    finally:
+        session.close()
+    if not recs:
+        return False
+    limite = datetime.now(timezone.utc) - timedelta(seconds=ENRIQUECER_EDAD_MIN)
+    for r in recs:
+        frescura = _frescura(r)
+        if not _esta_enriquecido(r.detalle) or frescura is None or frescura <= limite:
+            return False
+    return True
+
+
+def solicitar_enriquecimiento(shipment_id: str) -> bool:
+    """
+    Encola el shipment para re-enriquecer (no bloquea). Devuelve False si ya estaba
+    pendiente o si la cola está llena; si se enriqueció hace poco lo descarta el worker
+    (la consulta a la base no se hace en el request).
+    """
+    if not shipment_id or _cola is None:
+        return False
+    shipment_id = str(shipment_id)
+    if shipment_id in _en_curso:
+        _stats["duplicados"] += 1
+        return False
+    try:
+        _cola.put_nowait(shipment_id)
+    except asyncio.QueueFull:
+        _stats["descartados"] += 1
+        logger.warning("Cola de enriquecimiento llena, se descarta %s", shipment_id)
+        return False
+    _en_curso.add(shipment_id)
+    _stats["encolados"] += 1
+    return True
+
+
+async def _enriquecer(shipment_id: str):
+    db = SessionLocal()
+    try:
+        # Trae y guarda/enriquece desde la API
+        await get_order_details(shipment_id=shipment_id, db=db)
+
+        # ⚠️ Puede haber varias filas con el mismo shipment_id (distintos order_id)
+        recs = (db.query(MLPedidoCache)
+                  .filter(MLPedidoCache.shipment_id == shipment_id)
+                  .order_by(MLPedidoCache.fecha_consulta.desc())
+                  .all())
+
+        for rec in recs:
+            if hasattr(rec, "is_enriched"):
+                rec.is_enriched = True
+            if hasattr(rec, "last_enriched_at"):
+                rec.last_enriched_at = datetime.now(timezone.utc)
+
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+async def _worker(n: int):
+    while True:
+        shipment_id = await _cola.get()
+        try:
+            if await asyncio.to_thread(_reciente, shipment_id):
+                _stats["recientes"] += 1
+            else:
+                await _enriquecer(shipment_id)
+                _stats["ok"] += 1
+        except Exception as e:
+            _stats["errores"] += 1
+            print(f"⚠️ Enriquecimiento falló para {shipment_id}: {e}")
+        finally:
+            _en_curso.discard(shipment_id)
+            _cola.task_done()
+
+
+def iniciar_enriquecedor():
+    """Crea la cola y los workers en el loop de la app (llamar en startup)."""
+    global _cola
+    _cola = asyncio.Queue(maxsize=max(1, ENRIQUECER_MAX_COLA))
+    for n in range(max(1, ENRIQUECER_WORKERS)):
+        _workers.append(asyncio.create_task(_worker(n)))
+
+
+async def detener_enriquecedor():
+    """Cancela los workers; lo que quedó en cola se descarta (se re-pide en el próximo escaneo)."""
+    global _cola
+    for t in _workers:
+        t.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+    _en_curso.clear()
+    _cola = None
+
+
+def estadisticas_enriquecimiento() -> dict:
+    return {**_stats, "en_cola": _cola.qsize() if _cola else 0, "en_curso": len(_en_curso)}
@@ -0,0 +1,109 @@
+# envios_ml.py
+"""
+Snapshot de /shipments/{id} con TTL corto, compartido por armar, despachar y el
+guardado en cache: status, logistic_type y order ids salen de una sola llamada
+a ML, y pedidos simultáneos del mismo envío esperan esa misma llamada.
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+import weakref
+
+from http_ml import fetch_api_async
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_TTL = float(os.getenv("ML_SNAPSHOT_TTL", "30"))   # segundos
+SNAPSHOT_MAX = 5000
+
+_snapshots = {}   # shipment_id -> (expira_monotonic, snapshot)
+_lock = threading.Lock()
+_en_vuelo = weakref.WeakKeyDictionary()   # loop -> {(shipment_id, Authorization | None): Task}
+_stats = {"hits": 0, "fetches": 0, "coalescidos": 0}
+
+
+def _snapshot_desde(shipment_id: str, data: dict) -> dict:
+    order_id = data.get("order_id")
+    return {
+        "shipment_id": shipment_id,
+        "status": data.get("status"),
+        "substatus": data.get("substatus"),
+        "logistic_type": data.get("logistic_type") or (data.get("logistic") or {}).get("type"),
+        "order_ids": [str(order_id)] if order_id else [],
+    }
+
+
+def guardar_snapshot(shipment_id, data: dict) -> dict:
+    """Registra un /shipments/{id} que ya se trajo por otro camino (p.ej. get_order_details)."""
+    sid = str(shipment_id).strip()
+    snap = _snapshot_desde(sid, data)
+    ahora = time.monotonic()
+    with _lock:
+        _snapshots[sid] = (ahora + SNAPSHOT_TTL, snap)
+        if len(_snapshots) > SNAPSHOT_MAX:
+            for k in [k for k, (exp, _) in _snapshots.items() if exp < ahora]:
+                del _snapshots[k]
+    return snap
+
+
+def _vigente(sid: str):
+    with _lock:
+        entry = _snapshots.get(sid)
+    if entry and entry[0] > time.monotonic():
+        return entry[1]
+    return None
+
+
+def snapshot_vigente(shipment_id):
+    """El snapshot del envío si sigue dentro del TTL, sin salir a la red; si no, None."""
+    snap = _vigente(str(shipment_id).strip())
+    if snap is not None:
+        _stats["hits"] += 1
+    return snap
+
+
+def invalidar_snapshot(shipment_id):
+    """Descarta el snapshot (p.ej. llegó un webhook de la orden): la próxima consulta va a ML."""
+    with _lock:
+        _snapshots.pop(str(shipment_id).strip(), None)
+
+
+async def obtener_snapshot_envio(shipment_id, extra_headers=None, forzar: bool = False) -> dict:
+    """
+    {"shipment_id", "status", "substatus", "logistic_type", "order_ids"} del envío.
+    Dentro del TTL no sale a la red; si falla la llamada a ML propaga la excepción.
+    Solo se coalescen llamadas con la misma credencial (la de extra_headers o la del
+    gestor de tokens), así un token inválido no le hace fallar la llamada a otro; el
+    snapshot guardado sí es uno por envío.
+    """
+    sid = str(shipment_id).strip()
+    if not forzar:
+        snap = _vigente(sid)
+        if snap is not None:
+            _stats["hits"] += 1
+            return snap
+
+    clave = (sid, (extra_headers or {}).get("Authorization"))
+    vuelo = _en_vuelo.setdefault(asyncio.get_running_loop(), {})
+    task = vuelo.get(clave)
+    if task is not None:
+        _stats["coalescidos"] += 1
+        return await asyncio.shield(task)
+
+    async def _traer():
+        data = await fetch_api_async(f"/shipments/{sid}", extra_headers=extra_headers)
+        return guardar_snapshot(sid, data)
+
+    _stats["fetches"] += 1
+    task = asyncio.get_running_loop().create_task(_traer())
+    vuelo[clave] = task
+    task.add_done_callback(lambda t: vuelo.pop(clave, None) if vuelo.get(clave) is t else None)
+    return await asyncio.shield(task)
+
+
+def estadisticas_snapshots() -> dict:
+    with _lock:
+        n = len(_snapshots)
+    return {**_stats, "en_memoria": n}
@@ -0,0 +1,334 @@
+# http_ml.py
+"""
+Cliente HTTP compartido para api.mercadolibre.com.
+
+Un único httpx.Client (sync) por proceso y un httpx.AsyncClient por event loop,
+ambos con pool de conexiones y keep-alive, así no pagamos el handshake TLS en
+cada llamada a ML.
+
+Todas las llamadas pasan por un token bucket compartido por el proceso (tasa y
+ráfaga configurables) y se reintentan con backoff exponencial + jitter ante 429,
+5xx o errores de red, respetando Retry-After. Un 429 además frena el bucket para
+todos, así al llegar al límite el throughput baja parejo en vez de caerse.
+"""
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+import weakref
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from urllib.parse import urlencode
+
+import httpx
+
+from auth_ml import get_ml_token, get_ml_token_async
+from crud.validadores_ml import leer_respuesta, guardar_respuesta, tocar_respuesta
+
+logger = logging.getLogger(__name__)
+
+API_BASE = os.getenv("ML_API_BASE", "https://api.mercadolibre.com")
+
+# Timeouts (segundos) y tamaño del pool, configurables por env
+HTTP_TIMEOUT          = float(os.getenv("ML_HTTP_TIMEOUT", "10"))
+HTTP_CONNECT_TIMEOUT  = float(os.getenv("ML_HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_MAX_CONNECTIONS  = int(os.getenv("ML_HTTP_MAX_CONNECTIONS", "50"))
+HTTP_MAX_KEEPALIVE    = int(os.getenv("ML_HTTP_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("ML_HTTP_KEEPALIVE_EXPIRY", "60"))
+
+# Límite de salida hacia ML y reintentos
+RATE_POR_SEG      = float(os.getenv("ML_RATE_POR_SEG", "10"))
+RATE_RAFAGA       = int(os.getenv("ML_RATE_RAFAGA", "20"))
+REINTENTOS        = int(os.getenv("ML_HTTP_REINTENTOS", "3"))
+BACKOFF_BASE      = float(os.getenv("ML_HTTP_BACKOFF_BASE", "0.5"))   # segundos
+BACKOFF_MAX       = float(os.getenv("ML_HTTP_BACKOFF_MAX", "30"))
+STATUS_REINTENTAR = {429, 500, 502, 503, 504}
+
+_sync_client = None
+_sync_lock = threading.Lock()
+# Un AsyncClient por loop: el pool de conexiones queda atado al loop que lo creó
+_async_clients = weakref.WeakKeyDictionary()
+
+
+class TokenBucket:
+    """
+    Token bucket thread-safe. `reservar()` descuenta un token y devuelve cuánto hay
+    que esperar (los tokens pueden quedar negativos: cada llamador reserva su turno),
+    así sirve igual para código sync (time.sleep) y async (asyncio.sleep).
+    """
+
+    def __init__(self, tasa: float, rafaga: int):
+        self.tasa = max(tasa, 0.001)
+        self.rafaga = max(1, rafaga)
+        self._tokens = float(self.rafaga)
+        self._ultimo = time.monotonic()
+        self._pausa_hasta = 0.0
+        self._lock = threading.Lock()
+
+    def reservar(self) -> float:
+        with self._lock:
+            ahora = time.monotonic()
+            self._tokens = min(self.rafaga, self._tokens + (ahora - self._ultimo) * self.tasa)
+            self._ultimo = ahora
+            self._tokens -= 1
+            espera = -self._tokens / self.tasa if self._tokens < 0 else 0.0
+            return max(espera, self._pausa_hasta - ahora)
+
+    def pausar(self, segundos: float):
+        """Frena a todos los llamadores (p.ej. ML devolvió 429 con Retry-After)."""
+        with self._lock:
+            self._pausa_hasta = max(self._pausa_hasta, time.monotonic() + segundos)
+            self._tokens = min(self._tokens, 0.0)
+
+
+_bucket = TokenBucket(RATE_POR_SEG, RATE_RAFAGA)
+_stats_lock = threading.Lock()
+_stats = {"llamadas": 0, "limitadas": 0, "espera_limitador_s": 0.0,
+          "reintentos": 0, "respuestas_429": 0, "respuestas_5xx": 0, "errores_red": 0, "fallidas": 0,
+          "no_modificadas": 0}
+
+
+def _contar(**deltas):
+    with _stats_lock:
+        for k, v in deltas.items():
+            _stats[k] += v
+
+
+def estadisticas_http() -> dict:
+    """Llamadas a ML, cuántas esperaron al limitador, reintentos, respuestas 429/5xx y 304."""
+    with _stats_lock:
+        return {**_stats, "espera_limitador_s": round(_stats["espera_limitador_s"], 2),
+                "rate_por_seg": RATE_POR_SEG, "rafaga": RATE_RAFAGA}
+
+
+def _turno() -> float:
+    espera = _bucket.reservar()
+    _contar(llamadas=1)
+    if espera > 0:
+        _contar(limitadas=1, espera_limitador_s=espera)
+    return espera
+
+
+def _retry_after(r: httpx.Response):
+    valor = r.headers.get("Retry-After")
+    if not valor:
+        return None
+    try:
+        return max(0.0, float(valor))
+    except ValueError:
+        try:
+            return max(0.0, (parsedate_to_datetime(valor) - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return None
+
+
+def _backoff(intento: int) -> float:
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** intento))   # full jitter
+
+
+def _evaluar(r: httpx.Response | None, error: Exception | None, intento: int):
+    """None si la respuesta sirve; si no, los segundos a esperar antes de reintentar."""
+    if error is not None:
+        _contar(errores_red=1)
+    elif r.status_code == 429:
+        _contar(respuestas_429=1)
+    elif r.status_code >= 500:
+        _contar(respuestas_5xx=1)
+    if error is None and r.status_code not in STATUS_REINTENTAR:
+        return None
+    if intento >= REINTENTOS:
+        _contar(fallidas=1)
+        return None
+    espera = (_retry_after(r) if r is not None else None)
+    espera = _backoff(intento) if espera is None else min(espera, BACKOFF_MAX)
+    if r is not None and r.status_code == 429:
+        _bucket.pausar(espera)
+    _contar(reintentos=1)
+    return espera
+
+
+def _timeout() -> httpx.Timeout:
+    return httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
+
+
+def get_client() -> httpx.Client:
+    """Cliente sync compartido (para código que no corre dentro del loop)."""
+    global _sync_client
+    if _sync_client is None or _sync_client.is_closed:
+        with _sync_lock:
+            if _sync_client is None or _sync_client.is_closed:
+                _sync_client = httpx.Client(base_url=API_BASE, timeout=_timeout(), limits=_limits())
+    return _sync_client
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """Cliente async compartido para el event loop actual."""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(base_url=API_BASE, timeout=_timeout(), limits=_limits())
+        _async_clients[loop] = client
+    return client
+
+
+def close_client():
+    global _sync_client
+    with _sync_lock:
+        if _sync_client is not None:
+            _sync_client.close()
+            _sync_client = None
+
+
+async def aclose_async_client():
+    """Cierra el cliente async del loop actual (llamar en el shutdown de la app)."""
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+def _trae_auth(extra_headers) -> bool:
+    """Si el llamador ya manda su Authorization, no hace falta pedirle token al gestor."""
+    return bool(extra_headers and extra_headers.get("Authorization"))
+
+
+def _api_headers(token, extra_headers=None) -> dict:
+    headers = {"Authorization": f"Bearer {token}"} if token else {}
+    if extra_headers:
+        headers.update(extra_headers)
+    if not headers.get("Authorization"):
+        raise RuntimeError("No hay token válido para llamar a la API de Mercado Libre")
+    return headers
+
+
+def _get(path, headers, params=None) -> httpx.Response:
+    """GET con limitador y reintentos (cliente sync). Devuelve la respuesta final sin validar status."""
+    intento = 0
+    while True:
+        espera = _turno()
+        if espera > 0:
+            time.sleep(espera)
+        r = error = None
+        try:
+            r = get_client().get(path, headers=headers, params=params)
+        except httpx.TransportError as e:
+            error = e
+        espera = _evaluar(r, error, intento)
+        if espera is None:
+            break
+        logger.info("ML %s → %s, reintento %s en %.1fs", path, error or r.status_code, intento + 1, espera)
+        time.sleep(espera)
+        intento += 1
+    if error is not None:
+        raise error
+    return r
+
+
+async def _get_async(path, headers, params=None) -> httpx.Response:
+    """Igual que _get pero sin bloquear el event loop."""
+    intento = 0
+    while True:
+        espera = _turno()
+        if espera > 0:
+            await asyncio.sleep(espera)
+        r = error = None
+        try:
+            r = await get_async_client().get(path, headers=headers, params=params)
+        except httpx.TransportError as e:
+            error = e
+        espera = _evaluar(r, error, intento)
+        if espera is None:
+            break
+        logger.info("ML %s → %s, reintento %s en %.1fs", path, error or r.status_code, intento + 1, espera)
+        await asyncio.sleep(espera)
+        intento += 1
+    if error is not None:
+        raise error
+    return r
+
+
+def fetch_api(path, params=None, extra_headers=None):
+    """
+    GET genérico a api.mercadolibre.com con manejo de token (cliente sync compartido).
+    """
+    token = None if _trae_auth(extra_headers) else get_ml_token()
+    headers = _api_headers(token, extra_headers)
+    logger.debug("→ Llamando a ML API: GET %s%s  params=%s", API_BASE, path, params)
+    r = _get(path, headers, params)
+    r.raise_for_status()
+    return r.json()
+
+
+async def fetch_api_async(path, params=None, extra_headers=None):
+    """
+    Igual que fetch_api pero sin bloquear el event loop (cliente async compartido).
+    """
+    token = None if _trae_auth(extra_headers) else await get_ml_token_async()
+    headers = _api_headers(token, extra_headers)
+    logger.debug("→ Llamando a ML API: GET %s%s  params=%s", API_BASE, path, params)
+    r = await _get_async(path, headers, params)
+    r.raise_for_status()
+    return r.json()
+
+
+def _clave(path, params=None) -> str:
+    return path + ("?" + urlencode(sorted((params or {}).items())) if params else "")
+
+
+async def fetch_api_condicional(path, params=None, extra_headers=None, validadores=None):
+    """
+    GET condicional: si hay ETag/Last-Modified guardados para el recurso, manda
+    If-None-Match/If-Modified-Since. Devuelve (json, modificado); ante un 304
+    devuelve el cuerpo guardado con modificado=False.
+
+    Si se pasa `validadores` (una lista), los de un 200 no se guardan acá sino que
+    se agregan a la lista: el llamador los persiste con guardar_validadores() recién
+    cuando guardó lo que armó con esa respuesta. Así un 304 posterior no da por
+    vigente algo que nunca llegó a escribirse.
+    """
+    clave = _clave(path, params)
+    previo = await asyncio.to_thread(leer_respuesta, clave)
+    condicion = {}
+    if previo:
+        etag, last_modified, _ = previo
+        if etag:
+            condicion["If-None-Match"] = etag
+        if last_modified:
+            condicion["If-Modified-Since"] = last_modified
+    token = None if _trae_auth(extra_headers) else await get_ml_token_async()
+    headers = _api_headers(token, {**(extra_headers or {}), **condicion})
+    logger.debug("→ Llamando a ML API: GET %s%s  params=%s (condicional=%s)", API_BASE, path, params, bool(condicion))
+    r = await _get_async(path, headers, params)
+
+    if r.status_code == 304 and previo:
+        _contar(no_modificadas=1)
+        await asyncio.to_thread(tocar_respuesta, clave)
+        return previo[2], False
+
+    r.raise_for_status()
+    data = r.json()
+    etag, last_modified = r.headers.get("ETag"), r.headers.get("Last-Modified")
+    if etag or last_modified:
+        if validadores is not None:
+            validadores.append((clave, etag, last_modified, data))
+        else:
+            await guardar_validadores([(clave, etag, last_modified, data)])
+    return data, True
+
+
+async def guardar_validadores(validadores) -> None:
+    """Persiste los (clave, etag, last_modified, cuerpo) juntados por fetch_api_condicional."""
+    for clave, etag, last_modified, data in validadores or []:
+        try:
+            await asyncio.to_thread(guardar_respuesta, clave, etag, last_modified, data)
+        except Exception as e:
+            logger.warning("No se pudieron guardar validadores de %s: %s", clave, e)
@@ -1,10 +1,9 @@
 import os
 import csv
-import cv2
-import numpy as np
+import json
+import zlib
 import logging
 import asyncio
-import requests
 import httpx
 import secrets
 from fastapi import BackgroundTasks
@@ -43,26 +42,43 @@ from auth_ml import get_ml_token, obtener_token
 # CRUD
 from crud.pedidos import (
     add_order_if_not_exists,
+    add_orders_if_not_exist,
+    buscar_cache_por_shipments,
     marcar_envio_armado,
     marcar_pedido_despachado,
     get_all_pedidos,
+    get_pedidos_pagina,
+    contar_pedidos,
+    iterar_pedidos,
     get_estado_envio,
     marcar_pedido_con_feedback
 )
 from crud.usuarios import get_user_by_username, create_user
 from crud.logisticas import get_all_logisticas, add_logistica
+from crud.dashboard import leer_dashboard, recomputar_dashboard
 
 # WS externos
 from ws.items import buscar_item_por_sku
 from ws.catalogo import actualizar_ws_items
 
 # Lógica ML
-from api_ml import fetch_api, get_order_details,parse_order_data, guardar_pedido_en_cache
+from api_ml import (
+    fetch_api, get_order_details,parse_order_data, guardar_pedido_en_cache, estadisticas_coalescencia,
+    gather_acotado, ORDER_CONCURRENCY,
+)
+from cache_ml import estadisticas_cache
+from envios_ml import obtener_snapshot_envio, estadisticas_snapshots
+from http_ml import close_client, aclose_async_client, fetch_api_async, estadisticas_http
 
 
 # Webhooks
-from webhooks import webhooks  # 👈 importa el router desde webhooks.py
-from database.connection import get_db
+from webhooks import webhooks, iniciar_workers, detener_workers, metricas_cola  # 👈 importa el router desde webhooks.py
+from enriquecimiento import (
+    solicitar_enriquecimiento, iniciar_enriquecedor, detener_enriquecedor, estadisticas_enriquecimiento
+)
+from database.connection import get_db, estadisticas_pool
+from calentamiento import calentamiento_programado, CALENTAR_HORA
+from qr_decoder import decodificar_qr, decodificar_lote, shipment_id_desde_qr, estadisticas_qr, cerrar_pool as cerrar_pool_qr
 
 PEPPER = os.getenv("PASS_PEPPER", "")
 MASTER_KEY = os.getenv("MASTER_RESET_KEY", "silmarreset2024")
@@ -82,49 +98,83 @@ templates = Jinja2Templates(directory="templates")
 app.include_router(webhooks, prefix="/webhooks")
 PEPPER = os.getenv("PASS_PEPPER", "")   
 
-db = SessionLocal()
 router = APIRouter()
 
-TTL_MIN = 10
+ESCANEAR_LOTE_MAX = int(os.getenv("ESCANEAR_LOTE_MAX", "100"))
+DASHBOARD_RECALCULO_MIN = int(os.getenv("DASHBOARD_RECALCULO_MIN", "10"))
+_tareas_bg = []
+
+def _auth_env():
+    # ML_ACCESS_TOKEN fijo en el entorno tiene prioridad sobre el token manager (como antes)
+    token = os.getenv("ML_ACCESS_TOKEN")
+    return {"Authorization": f"Bearer {token}"} if token else None
+
 
 def _esta_enriquecido(detalle):
     return isinstance(detalle, list) and detalle and isinstance(detalle[0], dict) and "titulo" in detalle[0]
 
 
-def _enriquecer_bg(shipment_id: str):
-    from database.connection import SessionLocal
-    from database.models import MLPedidoCache
-    db = SessionLocal()
-    try:
-        import asyncio
-        # Trae y guarda/enriquece desde la API
-        asyncio.run(get_order_details(shipment_id=shipment_id, db=db))
-
-        # ⚠️ Puede haber varias filas con el mismo shipment_id (distintos order_id)
-        recs = (db.query(MLPedidoCache)
-                  .filter(MLPedidoCache.shipment_id == shipment_id)
-                  .order_by(MLPedidoCache.fecha_consulta.desc())
-                  .all())
-
-        for rec in recs:
-            if hasattr(rec, "is_enriched"):
-                rec.is_enriched = True
-            if hasattr(rec, "last_enriched_at"):
-                rec.last_enriched_at = datetime.now(timezone.utc)
+def _detalle_desde_cache(shipment_id: str, recs) -> dict | None:
+    """Mergea las filas enriquecidas de un shipment (multi-orden); None si ninguna lo está."""
+    recs_enriquecidos = [r for r in recs if _esta_enriquecido(getattr(r, "detalle", None))]
+    if not recs_enriquecidos:
+        return None
+
+    items, order_ids = [], []
+    cliente = ""
+    estado_envio = ""
+    estado_ml = ""
+
+    for r in recs_enriquecidos:
+        if r.order_id: order_ids.append(r.order_id)
+        cliente = cliente or (r.cliente or "")
+        estado_envio = estado_envio or (r.estado_envio or "")
+        estado_ml = estado_ml or (r.estado_ml or "")
+        items.extend(r.detalle)
+
+    return {
+        "primer_shipment_id": shipment_id,
+        "order_ids": list(dict.fromkeys(order_ids)),
+        "cliente": cliente,
+        "estado_envio": estado_envio or "sin_envio",
+        "estado_ml": estado_ml or "unknown",
+        "items": items
+    }
+
+
+async def _recalculo_dashboard_periodico():
+    # Recalcula los contadores desde cero cada tanto para corregir cualquier deriva
+    while True:
+        try:
+            await asyncio.to_thread(recomputar_dashboard)
+        except Exception as e:
+            logger.error("Recálculo del dashboard falló: %s", e)
+        await asyncio.sleep(DASHBOARD_RECALCULO_MIN * 60)
 
-        db.commit()
-    except Exception as e:
-        print(f"⚠️ Enriquecimiento falló para {shipment_id}: {e}")
-        db.rollback()
-    finally:
-        db.close()
-        
 @app.on_event("startup")
-def startup():
+async def startup():
     try:
-        init_db()
+        await asyncio.to_thread(init_db)
     except Exception as e:
         logger.error("init_db falló: %s", e)
+    _tareas_bg.append(asyncio.create_task(_recalculo_dashboard_periodico()))
+    # Workers que drenan la cola durable de webhooks
+    iniciar_workers()
+    iniciar_enriquecedor()
+    # Precalentado diario de la cache antes del turno (si CALENTAR_HORA está configurada)
+    if CALENTAR_HORA:
+        _tareas_bg.append(asyncio.create_task(calentamiento_programado()))
+
+@app.on_event("shutdown")
+async def shutdown():
+    for t in _tareas_bg:
+        t.cancel()
+    await detener_workers()
+    await detener_enriquecedor()
+    # Cerrar los pools de conexiones hacia ML
+    await aclose_async_client()
+    close_client()
+    cerrar_pool_qr()
 
 async def get_current_user(request: Request):
     user = request.session.get("username")
@@ -229,7 +279,11 @@ async def logout(request: Request):
 
 
 @app.get("/configuracion", response_class=HTMLResponse)
-async def configuracion_get(request: Request, current_user: dict = Depends(get_current_user)):
+async def configuracion_get(
+    request: Request,
+    current_user: dict = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
     logisticas = get_all_logisticas(db)
     return templates.TemplateResponse("configuracion.html", {"request": request, "usuario": current_user["username"], "logisticas": logisticas})
 
@@ -312,6 +366,9 @@ async def exportar_csv(
     logistica: str = Query(None),
     fecha_desde: str = Query(None),
     fecha_hasta: str = Query(None),
+    armado_desde: str = Query(None),
+    armado_hasta: str = Query(None),
+    comprimir: bool = Query(False),
 ):
     def parse_fecha(fecha_str):
         try:
@@ -319,55 +376,66 @@ async def exportar_csv(
         except:
             return None
 
-    desde = parse_fecha(fecha_desde)
-    hasta = parse_fecha(fecha_hasta)
-    pedidos = get_all_pedidos()
-
-    filtrados = []
-    for p in pedidos:
-        cumple_estado = not estado or estado == "Todos" or p["estado"] == estado.lower()
-        cumple_order_id = not order_id or order_id in str(p["order_id"])
-        cumple_logistica = not logistica or logistica == (p["logistica"] or "")
-
-        fecha_pedido = None
-        if p.get("fecha_despacho"):
-            try:
-                fecha_pedido = datetime.strptime(p["fecha_despacho"], "%Y-%m-%d").date()
-            except:
-                pass
-
-        cumple_fecha = True
-        if desde and fecha_pedido:
-            cumple_fecha = cumple_fecha and (fecha_pedido >= desde)
-        if hasta and fecha_pedido:
-            cumple_fecha = cumple_fecha and (fecha_pedido <= hasta)
-
-        if cumple_estado and cumple_order_id and cumple_logistica and cumple_fecha:
-            filtrados.append(p)
-
-    # Escribimos el CSV en memoria
-    output = StringIO()
-    writer = csv.writer(output)
-    writer.writerow([
-        "Order ID", "Cliente", "Título", "Cantidad", "Estado",
-        "Fecha Despacho", "Logística", "Usuario Armado", "Usuario Despacho"
-    ])
-    for p in filtrados:
+    filtros = {
+        "estado": estado,
+        "order_id": order_id,
+        "logistica": logistica,
+        "despacho_desde": parse_fecha(fecha_desde),
+        "despacho_hasta": parse_fecha(fecha_hasta),
+        "armado_desde": parse_fecha(armado_desde),
+        "armado_hasta": parse_fecha(armado_hasta),
+    }
+    FILAS_POR_CHUNK = 500
+
+    def generar_csv():
+        # CSV incremental: se vacía el buffer cada FILAS_POR_CHUNK filas
+        output = StringIO()
+        writer = csv.writer(output)
         writer.writerow([
-            p["order_id"],
-            p["cliente"],
-            p["titulo"],
-            p["cantidad"],
-            p["estado"],
-            p.get("fecha_despacho") or "—",
-            p.get("logistica") or "—",
-            p.get("usuario_armado") or "-",
-            p.get("usuario_despacho") or "—"
+            "Order ID", "Cliente", "Título", "Cantidad", "Estado",
+            "Fecha Despacho", "Logística", "Usuario Armado", "Usuario Despacho"
         ])
-
-    output.seek(0)
+        yield output.getvalue().encode("utf-8")
+        output.seek(0)
+        output.truncate()
+
+        for n, p in enumerate(iterar_pedidos(**filtros), start=1):
+            writer.writerow([
+                p["order_id"],
+                p["cliente"],
+                p["titulo"],
+                p["cantidad"],
+                p["estado"],
+                p.get("fecha_despacho") or "—",
+                p.get("logistica") or "—",
+                p.get("usuario_armado") or "-",
+                p.get("usuario_despacho") or "—"
+            ])
+            if n % FILAS_POR_CHUNK == 0:
+                yield output.getvalue().encode("utf-8")
+                output.seek(0)
+                output.truncate()
+
+        if output.tell():
+            yield output.getvalue().encode("utf-8")
+
+    def generar_gzip():
+        z = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 → formato gzip
+        for chunk in generar_csv():
+            comprimido = z.compress(chunk)
+            if comprimido:
+                yield comprimido
+        yield z.flush()
+
+    # Generadores sync: Starlette los corre en el threadpool, la DB no bloquea el loop
+    if comprimir:
+        return StreamingResponse(
+            generar_gzip(),
+            media_type="application/gzip",
+            headers={"Content-Disposition": "attachment; filename=historial_pedidos.csv.gz"}
+        )
     return StreamingResponse(
-        output,
+        generar_csv(),
         media_type="text/csv",
         headers={"Content-Disposition": "attachment; filename=historial_pedidos.csv"}
     )
@@ -382,10 +450,13 @@ async def historial_get(
     logistica: str = Query(None),
     fecha_desde: str = Query(None),
     fecha_hasta: str = Query(None),
-    page: int = Query(1)
+    armado_desde: str = Query(None),
+    armado_hasta: str = Query(None),
+    page: int = Query(1),
+    cursor: str = Query(None),
+    dir: str = Query(None),
 ):
     usuario = current_user["username"]
-    pedidos = get_all_pedidos()
 
     def parse_fecha(fecha_str):
         try:
@@ -393,50 +464,52 @@ async def historial_get(
         except:
             return None
 
-    desde = parse_fecha(fecha_desde)
-    hasta = parse_fecha(fecha_hasta)
-
-    filtrados = []
-    for p in pedidos:
-        cumple_estado = not estado or estado == "Todos" or p["estado"] == estado.lower()
-        cumple_order_id = not order_id or order_id in str(p["order_id"])
-        cumple_logistica = not logistica or logistica == (p["logistica"] or "")
-
-        fecha_pedido = None
-        if p.get("fecha_despacho"):
-            try:
-                fecha_pedido = datetime.strptime(p["fecha_despacho"], "%Y-%m-%d").date()
-            except:
-                pass
-
-        cumple_fecha = True
-        if desde and fecha_pedido:
-            cumple_fecha = cumple_fecha and (fecha_pedido >= desde)
-        if hasta and fecha_pedido:
-            cumple_fecha = cumple_fecha and (fecha_pedido <= hasta)
-
-        if cumple_estado and cumple_order_id and cumple_logistica and cumple_fecha:
-            filtrados.append(p)
+    # Filtros y paginación resueltos en SQL (keyset sobre fecha_despacho, id)
+    filtros = {
+        "estado": estado,
+        "order_id": order_id,
+        "logistica": logistica,
+        "despacho_desde": parse_fecha(fecha_desde),
+        "despacho_hasta": parse_fecha(fecha_hasta),
+        "armado_desde": parse_fecha(armado_desde),
+        "armado_hasta": parse_fecha(armado_hasta),
+    }
 
     PAGE_SIZE = 20
-    total = len(filtrados)
+    page = max(page, 1)
+    total = await asyncio.to_thread(contar_pedidos, **filtros)
     total_pages = (total + PAGE_SIZE - 1) // PAGE_SIZE
-    inicio = (page - 1) * PAGE_SIZE
-    fin = inicio + PAGE_SIZE
-    pagina_actual = filtrados[inicio:fin]
+
+    try:
+        pagina_actual, cursor_sig, cursor_ant = await asyncio.to_thread(
+            get_pedidos_pagina,
+            limite=PAGE_SIZE,
+            cursor=cursor,
+            hacia_atras=(dir == "prev"),
+            # Links viejos ?page=N sin cursor: caemos a OFFSET
+            offset=None if cursor else (page - 1) * PAGE_SIZE,
+            **filtros,
+        )
+    except ValueError:
+        # Cursor inválido → primera página
+        page = 1
+        pagina_actual, cursor_sig, cursor_ant = await asyncio.to_thread(
+            get_pedidos_pagina, limite=PAGE_SIZE, **filtros
+        )
 
     # Armado de URLs de paginación segura
-    query_params = dict(request.query_params)
+    query_params = {k: v for k, v in request.query_params.items() if k not in ("cursor", "dir", "page")}
 
     siguiente_url = None
-    if page < total_pages:
-        query_params["page"] = page + 1
-        siguiente_url = f"?{urlencode(query_params)}"
+    if cursor_sig and page < total_pages:
+        siguiente_url = f"?{urlencode({**query_params, 'page': page + 1, 'cursor': cursor_sig})}"
 
     anterior_url = None
     if page > 1:
-        query_params["page"] = page - 1
-        anterior_url = f"?{urlencode(query_params)}"
+        if page == 2 or not cursor_ant:
+            anterior_url = f"?{urlencode(query_params)}"
+        else:
+            anterior_url = f"?{urlencode({**query_params, 'page': page - 1, 'cursor': cursor_ant, 'dir': 'prev'})}"
 
     return templates.TemplateResponse("historial.html", {
         "request": request,
@@ -447,6 +520,8 @@ async def historial_get(
         "filtro_logistica": logistica or "",
         "filtro_fecha_desde": fecha_desde or "",
         "filtro_fecha_hasta": fecha_hasta or "",
+        "filtro_armado_desde": armado_desde or "",
+        "filtro_armado_hasta": armado_hasta or "",
         "pagina_actual": page,
         "total_paginas": total_pages,
         "siguiente_url": siguiente_url,
@@ -462,7 +537,6 @@ async def escanear_post(
     request: Request,
     order_id: str = Form(None),
     shipment_id: str = Form(None),
-    background: BackgroundTasks = None,
     current_user: dict = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
@@ -480,41 +554,15 @@ async def escanear_post(
             )
 
             if recs:
-                # ¿Hay alguna fila ya enriquecida?
-                recs_enriquecidos = [r for r in recs if _esta_enriquecido(getattr(r, "detalle", None))]
+                detalle = _detalle_desde_cache(shipment_id, recs)
 
-                if not recs_enriquecidos:
+                if detalle is None:
                     # 👉 Primer hit: no hay cache útil → enriquecer SINCRÓNICO
                     detalle = await get_order_details(shipment_id=shipment_id, db=db)
                     return {"success": True, "detalle": detalle}
 
-                # Hay al menos una fila con detalle OK → mergear
-                items, order_ids = [], []
-                cliente = ""
-                estado_envio = ""
-                estado_ml = ""
-
-                for r in recs_enriquecidos:
-                    if r.order_id: order_ids.append(r.order_id)
-                    cliente = cliente or (r.cliente or "")
-                    estado_envio = estado_envio or (r.estado_envio or "")
-                    estado_ml = estado_ml or (r.estado_ml or "")
-                    items.extend(r.detalle)
-
-                order_ids = list(dict.fromkeys(order_ids))
-
-                detalle = {
-                    "primer_shipment_id": shipment_id,
-                    "order_ids": order_ids,
-                    "cliente": cliente,
-                    "estado_envio": estado_envio or "sin_envio",
-                    "estado_ml": estado_ml or "unknown",
-                    "items": items
-                }
-
                 # Refrescar en background (no bloquea)
-                if background:
-                    background.add_task(_enriquecer_bg, shipment_id)
+                solicitar_enriquecimiento(shipment_id)
 
                 return {"success": True, "detalle": detalle}
         # 2) No hay cache útil → usa flujo consolidado (resolverá shipment si entra solo order)
@@ -546,8 +594,8 @@ async def escanear_post(
             print(f"⚠️ No se pudo preparar alta mínima en 'pedidos': {e}")
 
         # 5) Enriquecer en background si todavía no hay cache enriquecida
-        if sid and background:
-            background.add_task(_enriquecer_bg, sid)
+        if sid:
+            solicitar_enriquecimiento(sid)
 
         return {"success": True, "detalle": detalle}
 
@@ -556,23 +604,200 @@ async def escanear_post(
         return JSONResponse(status_code=500, content={"success": False, "error": "Error interno"})
 
 
+def _entradas_lote(ids) -> list:
+    """
+    Normaliza la lista del escáner a [(id_original, order_id, shipment_id)] sin repetidos.
+    Acepta strings (igual que parseQr: número pelado = order_id y shipment_id) o
+    dicts {"order_id", "shipment_id"}.
+    """
+    entradas, vistos = [], set()
+    for x in ids:
+        if isinstance(x, dict):
+            oid = str(x.get("order_id") or "").strip() or None
+            sid = str(x.get("shipment_id") or "").strip() or None
+        else:
+            sid = shipment_id_desde_qr(str(x))
+            oid = sid if str(x).strip().isdigit() else None
+        if not (oid or sid) or (oid, sid) in vistos:
+            continue
+        vistos.add((oid, sid))
+        entradas.append((x, oid, sid))
+    return entradas
+
+
+@app.post("/escanear/lote")
+async def escanear_lote(
+    request: Request,
+    current_user: dict = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """
+    /escanear para muchos ids a la vez ({"ids": [...]}, pensado para tandas de 20–50
+    del modo continuo). Responde NDJSON: una línea por id a medida que se resuelve
+    y al final una línea {"resumen": ...}.
+    """
+    try:
+        body = await request.json()
+    except Exception:
+        return JSONResponse(status_code=400, content={"success": False, "error": "JSON inválido"})
+    ids = body.get("ids") if isinstance(body, dict) else None
+    if not isinstance(ids, list):
+        return JSONResponse(status_code=400, content={"success": False, "error": "Falta la lista de ids"})
+    # el tope va sobre lo recibido, antes de normalizar (parsear miles de QR ya es trabajo)
+    if len(ids) > ESCANEAR_LOTE_MAX:
+        return JSONResponse(status_code=413, content={
+            "success": False, "error": f"Máximo {ESCANEAR_LOTE_MAX} ids por lote"})
+    entradas = _entradas_lote(ids)
+    if not entradas:
+        return JSONResponse(status_code=400, content={"success": False, "error": "Falta la lista de ids"})
+
+    # 1) Cache FIRST para todo el lote en una query
+    cache = buscar_cache_por_shipments(db, [sid for _, _, sid in entradas])
+    hits, faltan = [], []
+    for entrada in entradas:
+        _, _, sid = entrada
+        detalle = _detalle_desde_cache(sid, cache[sid]) if sid in cache else None
+        if detalle is not None:
+            hits.append((entrada, detalle))
+        else:
+            faltan.append(entrada)
+
+    async def _resolver(entrada, sem):
+        _, oid, sid = entrada
+        async with sem:
+            try:
+                return entrada, await get_order_details(order_id=oid, shipment_id=sid, db=db)
+            except Exception as e:
+                return entrada, e
+
+    async def _stream():
+        resumen = {"total": len(entradas), "cache": len(hits), "ml": 0, "errores": 0, "pedidos_nuevos": 0}
+        for (x, oid, sid), detalle in hits:
+            # Refrescar en background (no bloquea)
+            solicitar_enriquecimiento(sid)
+            yield json.dumps({"id": x, "shipment_id": sid, "success": True, "origen": "cache",
+                              "detalle": detalle}, default=str) + "\n"
+
+        # 2) Faltantes contra ML en paralelo (acotado); se emiten a medida que terminan
+        sem = asyncio.Semaphore(max(1, ORDER_CONCURRENCY))
+        tareas = [asyncio.create_task(_resolver(e, sem)) for e in faltan]
+        altas = []
+        try:
+            for fut in asyncio.as_completed(tareas):
+                (x, oid, sid), detalle = await fut
+                if isinstance(detalle, Exception):
+                    resumen["errores"] += 1
+                    print(f"❌ /escanear/lote error en {x}: {detalle}")
+                    yield json.dumps({"id": x, "shipment_id": sid, "order_id": oid,
+                                      "success": False, "error": "Error interno"}) + "\n"
+                    continue
+                sid = sid or detalle.get("primer_shipment_id")
+                if detalle.get("cliente") == "Error" or not detalle.get("items"):
+                    resumen["errores"] += 1
+                    msg = ("Pedido cancelado" if detalle.get("estado_ml") == "cancelled"
+                           else "No se encontraron ítems para este pedido")
+                    yield json.dumps({"id": x, "shipment_id": sid, "order_id": oid,
+                                      "success": False, "error": msg}) + "\n"
+                    continue
+                resumen["ml"] += 1
+                primer_oid = detalle.get("primer_order_id")
+                if sid and primer_oid:
+                    altas.append({"cliente": detalle["cliente"], "items": [
+                        {"order_id": primer_oid, "titulo": i["titulo"], "cantidad": i["cantidad"], "shipment_id": sid}
+                        for i in detalle["items"]
+                    ]})
+                if sid:
+                    solicitar_enriquecimiento(sid)
+                yield json.dumps({"id": x, "shipment_id": sid, "success": True, "origen": "ml",
+                                  "detalle": detalle}, default=str) + "\n"
+        finally:
+            for t in tareas:
+                t.cancel()
+
+        # 3) Alta mínima en "pedidos" de todo el lote en una transacción
+        try:
+            resumen["pedidos_nuevos"] = await asyncio.to_thread(add_orders_if_not_exist, altas)
+        except Exception as e:
+            # No bloquees el flujo si falla el alta mínima
+            print(f"⚠️ No se pudo preparar alta mínima en 'pedidos': {e}")
+        yield json.dumps({"resumen": resumen}) + "\n"
+
+    return StreamingResponse(_stream(), media_type="application/x-ndjson")
+
+
 # main.py — reemplazá /decode-qr
 @app.post("/decode-qr", response_class=JSONResponse)
 async def decode_qr(frame: UploadFile = File(...), db: Session = Depends(get_db)):
     content = await frame.read()
-    arr = np.frombuffer(content, np.uint8)
-    img = cv2.imdecode(arr, cv2.IMREAD_COLOR)
-    data, _, _ = cv2.QRCodeDetector().detectAndDecode(img)
+    # Decodifica en el pool de OpenCV (no bloquea el loop): reducida → ROI → completa
+    res = await decodificar_qr(content)
+    data = res["data"]
 
     if not data:
-        return {"data": None, "error": "QR no detectado"}
+        return {"data": None, "error": "QR no detectado", "decode_ms": res["decode_ms"]}
 
     # Igual que /escanear, pero directo:
     detalle = await get_order_details(shipment_id=data, db=db)
     if detalle.get("cliente") == "Error" or not detalle.get("items"):
-        return {"data": data, "error": "No se encontraron ítems para este pedido", "detalle": None}
+        return {"data": data, "error": "No se encontraron ítems para este pedido", "detalle": None,
+                "decode_ms": res["decode_ms"]}
+
+    return {"data": data, "detalle": detalle, "decode_ms": res["decode_ms"], "pasada": res["pasada"]}
+
+@app.post("/decode-qr/lote", response_class=JSONResponse)
+async def decode_qr_lote(
+    archivo: UploadFile = File(...),
+    current_user: dict = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """
+    Hoja de etiquetas (foto o PDF de varias páginas): lee todos los QR, deduplica
+    los shipment_id y los resuelve en paralelo por el camino con cache de get_order_details.
+    """
+    content = await archivo.read()
+    es_pdf = (archivo.content_type == "application/pdf"
+              or (archivo.filename or "").lower().endswith(".pdf")
+              or content[:5] == b"%PDF-")
+    try:
+        lote = await decodificar_lote(content, es_pdf=es_pdf)
+    except RuntimeError as e:
+        return JSONResponse(status_code=400, content={"success": False, "error": str(e)})
+
+    # shipment_id -> páginas donde apareció (una etiqueta repetida se resuelve una sola vez)
+    paginas_por_sid = {}
+    ilegibles = []
+    for c in lote["codigos"]:
+        if c["shipment_id"]:
+            paginas_por_sid.setdefault(c["shipment_id"], []).append(c["pagina"])
+        else:
+            ilegibles.append({"pagina": c["pagina"], "data": c["data"]})
+
+    sids = list(paginas_por_sid)
+    detalles = await gather_acotado(
+        (get_order_details(shipment_id=sid, db=db) for sid in sids),
+        limite=ORDER_CONCURRENCY,
+    )
 
-    return {"data": data, "detalle": detalle}
+    etiquetas = []
+    for sid, detalle in zip(sids, detalles):
+        fila = {"shipment_id": sid, "paginas": sorted(set(paginas_por_sid[sid]))}
+        if isinstance(detalle, BaseException):
+            print(f"❌ /decode-qr/lote error en {sid}: {detalle!r}")
+            fila.update(success=False, error="Error consultando el envío")
+        elif detalle.get("cliente") == "Error" or not detalle.get("items"):
+            fila.update(success=False, error="No se encontraron ítems para este pedido", detalle=None)
+        else:
+            fila.update(success=True, detalle=detalle)
+        etiquetas.append(fila)
+
+    return {
+        "success": True,
+        "paginas": lote["paginas"],
+        "codigos_leidos": len(lote["codigos"]),
+        "etiquetas": etiquetas,
+        "ilegibles": ilegibles,
+        "decode_ms": lote["decode_ms"],
+    }
 
 @app.post("/armar", response_class=JSONResponse)
 async def armar_post(
@@ -594,22 +819,19 @@ async def armar_post(
 
             # 0.b) si no está en cache, lo resolvemos en ML
             if not sid:
-                token = os.getenv("ML_ACCESS_TOKEN")
-                if not token:
-                    token = get_ml_token()
-                url = f"https://api.mercadolibre.com/orders/{order_id}"
-                r = requests.get(url, headers={"Authorization": f"Bearer {token}"}, timeout=12)
-                if r.ok:
-                    sid = str(r.json().get("shipping", {}).get("id") or "")
+                try:
+                    od = await fetch_api_async(f"/orders/{order_id}", extra_headers=_auth_env())
+                    sid = str(od.get("shipping", {}).get("id") or "")
+                except httpx.HTTPStatusError:
+                    pass
         if not sid:
             return JSONResponse(status_code=400, content={"success": False, "error": "No se pudo determinar el shipment_id."})
 
         # 1) Guardrail: si el envío está cancelado, no permitir armar
         try:
-            token = os.getenv("ML_ACCESS_TOKEN") or get_ml_token()
-            rs = requests.get(f"https://api.mercadolibre.com/shipments/{sid}",
-                              headers={"Authorization": f"Bearer {token}"}, timeout=10)
-            if rs.ok and rs.json().get("status") == "cancelled":
+            # Snapshot compartido: si el envío se escaneó recién, no sale a la red
+            envio = await obtener_snapshot_envio(sid, extra_headers=_auth_env())
+            if envio.get("status") == "cancelled":
                 return JSONResponse(status_code=409, content={"success": False, "error": "El envío está cancelado (ML)."})
         except Exception as e:
             # no bloqueamos por fallo de red
@@ -634,6 +856,20 @@ async def armar_post(
 def estado_envio(shipment_id: str, current_user: dict = Depends(get_current_user)):
     return {"estado": get_estado_envio(shipment_id)}
 
+@app.get("/metricas", response_class=JSONResponse)
+async def metricas(current_user: dict = Depends(get_current_user)):
+    # Métricas internas para diagnóstico de performance
+    return {
+        "get_order_details": estadisticas_coalescencia(),
+        "cache_pedidos": estadisticas_cache(),
+        "snapshots_envio": estadisticas_snapshots(),
+        "ml_http": estadisticas_http(),
+        "webhooks": await metricas_cola(),
+        "enriquecimiento": estadisticas_enriquecimiento(),
+        "db_pool": estadisticas_pool(),
+        "qr": estadisticas_qr(),
+    }
+
 @app.get("/despachar", response_class=HTMLResponse)
 async def despachar_get(
     request: Request,
@@ -675,21 +911,16 @@ async def despachar_post(
             )
 
         # 2) Validar cancelado en API de ML (opcional si hay token)
-        token = os.getenv("ML_ACCESS_TOKEN")
-        if token:
+        if os.getenv("ML_ACCESS_TOKEN"):
             try:
-                url = f"https://api.mercadolibre.com/shipments/{shipment_id}"
-                headers = {"Authorization": f"Bearer {token}"}
-                r = requests.get(url, headers=headers, timeout=8)
-                if r.ok:
-                    data = r.json()
-                    if data.get("status") == "cancelled":
-                        return JSONResponse(
-                            status_code=409,
-                            content={"success": False, "error": "El envío está cancelado (API de ML)."}
-                        )
-            except requests.RequestException as e:
-                # No bloqueamos el despacho por un fallo de red; solo registramos
+                data = await obtener_snapshot_envio(shipment_id, extra_headers=_auth_env())
+                if data.get("status") == "cancelled":
+                    return JSONResponse(
+                        status_code=409,
+                        content={"success": False, "error": "El envío está cancelado (API de ML)."}
+                    )
+            except Exception as e:
+                # No bloqueamos el despacho por un fallo de ML (red, token, respuesta rara); solo registramos
                 print(f"⚠️ No se pudo validar en ML: {e}")
 
         # 3) Ejecutar despacho
@@ -716,98 +947,5 @@ async def despachar_post(
     
 @router.get("/dashboard/resumen")
 def resumen_dashboard(db: Session = Depends(get_db)):
-    ahora = datetime.now(timezone.utc)
-    hoy = ahora.date()
-
-    # Ventana: de ayer 14:00 a hoy 14:00 (UTC)
-    inicio = datetime.combine(hoy - timedelta(days=1), time(14, 0)).astimezone(timezone.utc)
-    fin    = datetime.combine(hoy,                 time(14, 0)).astimezone(timezone.utc)
-
-    print("🧪 Ventana de conteo:", inicio.isoformat(), "→", fin.isoformat())
-
-    # 🚫 Excluir FULL (fulfillment) en todas las consultas
-    no_full = (MLPedidoCache.logistic_type != 'fulfillment')
-
-    # === FLEX: self_service ===
-    flex_base = (
-        db.query(MLPedidoCache.shipment_id)
-          .filter(
-              MLPedidoCache.estado_ml != 'cancelled',
-              MLPedidoCache.fecha_consulta.between(inicio, fin),
-              MLPedidoCache.logistic_type == 'self_service',
-              no_full
-          )
-          .distinct()
-    )
-
-    # Total de shipments únicos que NO están armados
-    flex_total = (
-        flex_base
-        .outerjoin(Pedido, MLPedidoCache.shipment_id == Pedido.shipment_id)
-        .filter(or_(Pedido.estado == None, Pedido.estado != 'armado'))
-        .count()
-    )
-
-    # Shipments armados
-    flex_armados = (
-        db.query(func.count(distinct(Pedido.shipment_id)))
-          .join(MLPedidoCache, MLPedidoCache.shipment_id == Pedido.shipment_id)
-          .filter(
-              Pedido.estado == 'armado',
-              Pedido.fecha_armado.between(inicio, fin),
-              MLPedidoCache.logistic_type == 'self_service',
-              no_full
-          )
-          .scalar()
-    )
-
-    # === COLECTA: cross_docking ===
-    colecta_base = (
-        db.query(MLPedidoCache.shipment_id)
-          .filter(
-              MLPedidoCache.estado_ml != 'cancelled',
-              MLPedidoCache.fecha_consulta.between(inicio, fin),
-              MLPedidoCache.logistic_type == 'cross_docking',
-              no_full
-          )
-          .distinct()
-    )
-
-    colecta_total = (
-        colecta_base
-        .outerjoin(Pedido, MLPedidoCache.shipment_id == Pedido.shipment_id)
-        .filter(or_(Pedido.estado == None, Pedido.estado != 'armado'))
-        .count()
-    )
-
-    colecta_armados = (
-        db.query(func.count(distinct(Pedido.shipment_id)))
-          .join(MLPedidoCache, MLPedidoCache.shipment_id == Pedido.shipment_id)
-          .filter(
-              Pedido.estado == 'armado',
-              Pedido.fecha_armado.between(inicio, fin),
-              MLPedidoCache.logistic_type == 'cross_docking',
-              no_full
-          )
-          .scalar()
-    )
-
-    # Cancelados (por shipment) — también excluimos FULL
-    cancelados = (
-        db.query(distinct(MLPedidoCache.shipment_id))
-          .filter(
-              MLPedidoCache.estado_ml == 'cancelled',
-              MLPedidoCache.fecha_consulta.between(inicio, fin),
-              no_full
-          )
-          .all()
-    )
-    cancelados_ids = [r[0] for r in cancelados]
-
-    return {
-        "flex_total": flex_total,
-        "flex_armados": flex_armados,
-        "colecta_total": colecta_total,
-        "colecta_armados": colecta_armados,
-        "cancelados": cancelados_ids
-    }
\ No newline at end of file
+    # Una fila de contadores mantenidos al cachear/armar/despachar (ver crud/dashboard.py)
+    return leer_dashboard(db)
@@ -0,0 +1,238 @@
+# qr_decoder.py
+"""
+Decodificación de QR fuera del event loop.
+
+OpenCV libera el GIL, así que un ThreadPoolExecutor chico alcanza para que
+/decode-qr no frene al resto de los requests. Cada hilo reutiliza su propio
+cv2.QRCodeDetector (no es thread-safe compartirlo) y se prueba de lo más barato
+a lo más caro: imagen reducida → recorte central (opcional) → resolución completa.
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+import json
+import weakref
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+QR_WORKERS = int(os.getenv("QR_WORKERS", str(min(4, os.cpu_count() or 1))))
+QR_MAX_PENDIENTES = int(os.getenv("QR_MAX_PENDIENTES", str(QR_WORKERS * 4)))
+QR_LADO_REDUCIDO = int(os.getenv("QR_LADO_REDUCIDO", "800"))    # px del lado mayor en la 1ra pasada
+QR_ROI = float(os.getenv("QR_ROI", "0"))                         # fracción central a recortar (0 = no)
+QR_GRIS = os.getenv("QR_GRIS", "true").lower() in ("1", "true", "yes")
+QR_PDF_DPI = int(os.getenv("QR_PDF_DPI", "200"))                 # resolución al rasterizar PDFs de etiquetas
+QR_PDF_MAX_PAGINAS = int(os.getenv("QR_PDF_MAX_PAGINAS", "50"))
+
+_executor = ThreadPoolExecutor(max_workers=max(1, QR_WORKERS), thread_name_prefix="qr")
+_local = threading.local()
+_semaforos = weakref.WeakKeyDictionary()   # loop -> asyncio.Semaphore (acota lo encolado en el pool)
+_stats_lock = threading.Lock()
+_stats = {"total": 0, "sin_qr": 0, "ms_total": 0.0, "pasadas": {}}
+
+
+def _detector() -> "cv2.QRCodeDetector":
+    det = getattr(_local, "detector", None)
+    if det is None:
+        det = _local.detector = cv2.QRCodeDetector()
+    return det
+
+
+def _reducir(img, lado: int):
+    h, w = img.shape[:2]
+    mayor = max(h, w)
+    if lado <= 0 or mayor <= lado:
+        return None
+    escala = lado / mayor
+    return cv2.resize(img, (int(w * escala), int(h * escala)), interpolation=cv2.INTER_AREA)
+
+
+def _recorte_central(img, fraccion: float):
+    if not 0 < fraccion < 1:
+        return None
+    h, w = img.shape[:2]
+    dh, dw = int(h * (1 - fraccion) / 2), int(w * (1 - fraccion) / 2)
+    return img[dh:h - dh, dw:w - dw]
+
+
+def decodificar_bytes(content: bytes):
+    """
+    Decodifica (sincrónico) un frame en bytes. Devuelve (data | None, pasada | None),
+    donde pasada es "reducida", "roi" o "completa".
+    """
+    arr = np.frombuffer(content, np.uint8)
+    img = cv2.imdecode(arr, cv2.IMREAD_GRAYSCALE if QR_GRIS else cv2.IMREAD_COLOR)
+    if img is None:
+        return None, None
+    det = _detector()
+    pasadas = (
+        ("reducida", lambda: _reducir(img, QR_LADO_REDUCIDO)),
+        ("roi", lambda: _recorte_central(img, QR_ROI)),
+        ("completa", lambda: img),
+    )
+    for nombre, preparar in pasadas:
+        candidata = preparar()
+        if candidata is None:
+            continue
+        data, _, _ = det.detectAndDecode(candidata)
+        if data:
+            return data, nombre
+    return None, None
+
+
+def shipment_id_desde_qr(texto: str):
+    """
+    Extrae el shipment_id del contenido de una etiqueta (mismo criterio que parseQr
+    del front): JSON {"id": ...}, URL .../shipments/{id} o el texto pelado.
+    """
+    txt = (texto or "").strip()
+    if not txt:
+        return None
+    if txt.startswith("{"):
+        try:
+            obj = json.loads(txt)
+            return str(obj["id"]) if obj.get("id") else None
+        except (ValueError, AttributeError):
+            return None
+    url = urlparse(txt)
+    if url.scheme and url.netloc:
+        partes = [p for p in url.path.split("/") if p]
+        return partes[1] if len(partes) > 1 and partes[0] == "shipments" else None
+    return txt
+
+
+def _decodificar_multi(img) -> list:
+    """
+    Todos los QR de una imagen. Los que OpenCV ubica pero no logra leer en la
+    pasada conjunta se reintentan de a uno sobre su recorte ampliado.
+    """
+    det = _detector()
+    ok, textos, puntos, _ = det.detectAndDecodeMulti(img)
+    if not ok or puntos is None:
+        data, _, _ = det.detectAndDecode(img)
+        return [data] if data else []
+    leidos = []
+    h, w = img.shape[:2]
+    for texto, pts in zip(textos, puntos):
+        if not texto:
+            x0, y0 = pts.min(axis=0).astype(int)
+            x1, y1 = pts.max(axis=0).astype(int)
+            m = max(10, (x1 - x0) // 4)
+            recorte = img[max(0, y0 - m):min(h, y1 + m), max(0, x0 - m):min(w, x1 + m)]
+            if recorte.size:
+                recorte = cv2.resize(recorte, None, fx=2, fy=2, interpolation=cv2.INTER_CUBIC)
+                texto, _, _ = det.detectAndDecode(recorte)
+        if texto:
+            leidos.append(texto)
+    return leidos
+
+
+def _abrir_pdf(content: bytes):
+    try:
+        import pymupdf  # solo hace falta para subir PDFs
+    except ImportError:
+        raise RuntimeError("Para leer PDFs hace falta PyMuPDF (pip install pymupdf)")
+    return pymupdf.open(stream=content, filetype="pdf")
+
+
+def _decodificar_imagen(content: bytes) -> list:
+    img = cv2.imdecode(np.frombuffer(content, np.uint8), cv2.IMREAD_GRAYSCALE if QR_GRIS else cv2.IMREAD_COLOR)
+    return _decodificar_multi(img) if img is not None else []
+
+
+def _decodificar_pagina_pdf(doc, n: int) -> list:
+    """Rasteriza UNA página y la decodifica; la imagen se libera al terminar."""
+    png = doc[n].get_pixmap(dpi=QR_PDF_DPI).tobytes("png")
+    return _decodificar_imagen(png)
+
+
+def _semaforo() -> asyncio.Semaphore:
+    """Semáforo del loop actual: acota cuántos trabajos de QR hay encolados en el pool."""
+    loop = asyncio.get_running_loop()
+    sem = _semaforos.get(loop)
+    if sem is None:
+        sem = _semaforos[loop] = asyncio.Semaphore(max(1, QR_MAX_PENDIENTES))
+    return sem
+
+
+async def decodificar_lote(content: bytes, es_pdf: bool = False) -> dict:
+    """
+    Decodifica todos los QR de una imagen o de un PDF de varias páginas.
+    Las páginas se rasterizan y decodifican de a una (memoria acotada a una página),
+    cada una con un lugar del mismo semáforo que los /decode-qr sueltos, y como
+    mucho QR_PDF_MAX_PAGINAS.
+    Devuelve {"codigos": [{"pagina", "data", "shipment_id"}], "paginas", "decode_ms"}.
+    """
+    loop = asyncio.get_running_loop()
+    sem = _semaforo()
+    t0 = time.perf_counter()
+    resultados = []
+    if not es_pdf:
+        async with sem:
+            resultados.append(await loop.run_in_executor(_executor, _decodificar_imagen, content))
+    else:
+        doc = await loop.run_in_executor(_executor, _abrir_pdf, content)
+        try:
+            total = doc.page_count
+            if total > QR_PDF_MAX_PAGINAS:
+                logger.warning("PDF con %s páginas: se leen solo las primeras %s", total, QR_PDF_MAX_PAGINAS)
+            for n in range(min(total, QR_PDF_MAX_PAGINAS)):
+                async with sem:
+                    resultados.append(await loop.run_in_executor(_executor, _decodificar_pagina_pdf, doc, n))
+        finally:
+            doc.close()
+    codigos = [
+        {"pagina": n, "data": data, "shipment_id": shipment_id_desde_qr(data)}
+        for n, textos in enumerate(resultados, start=1)
+        for data in textos
+    ]
+    ms = (time.perf_counter() - t0) * 1000
+    logger.info("Lote QR: %s códigos en %s páginas, %.1f ms", len(codigos), len(resultados), ms)
+    return {"codigos": codigos, "paginas": len(resultados), "decode_ms": round(ms, 1)}
+
+
+def _registrar(pasada, ms: float):
+    with _stats_lock:
+        _stats["total"] += 1
+        _stats["ms_total"] += ms
+        if pasada:
+            _stats["pasadas"][pasada] = _stats["pasadas"].get(pasada, 0) + 1
+        else:
+            _stats["sin_qr"] += 1
+
+
+async def decodificar_qr(content: bytes) -> dict:
+    """
+    Decodifica en el pool sin bloquear el loop.
+    Devuelve {"data", "pasada", "decode_ms"}; decode_ms incluye la espera en el pool.
+    """
+    loop = asyncio.get_running_loop()
+    sem = _semaforo()
+    t0 = time.perf_counter()
+    async with sem:
+        data, pasada = await loop.run_in_executor(_executor, decodificar_bytes, content)
+    ms = (time.perf_counter() - t0) * 1000
+    _registrar(pasada, ms)
+    logger.info("QR %s en %.1f ms (pasada=%s)", "ok" if data else "no detectado", ms, pasada)
+    return {"data": data, "pasada": pasada, "decode_ms": round(ms, 1)}
+
+
+def estadisticas_qr() -> dict:
+    with _stats_lock:
+        n = _stats["total"]
+        return {
+            "total": n,
+            "sin_qr": _stats["sin_qr"],
+            "decode_prom_ms": round(_stats["ms_total"] / n, 1) if n else 0.0,
+            "pasadas": dict(_stats["pasadas"]),
+        }
+
+
+def cerrar_pool():
+    _executor.shutdown(wait=False, cancel_futures=True)
@@ -1,9 +1,26 @@
-from fastapi import APIRouter, Request, Depends
-from sqlalchemy.orm import Session
-from api_ml import get_order_details, guardar_pedido_en_cache, fetch_api
+import os
+import asyncio
+import logging
+from fastapi import APIRouter, Request
+from fastapi.responses import JSONResponse
+from api_ml import guardar_pedido_en_cache, fetch_api_async, gather_acotado, _pares_items
 from database.connection import SessionLocal
+from envios_ml import invalidar_snapshot
+from crud.ml_items import invalidar_item, precargar_items
+from crud.webhooks_cola import (
+    encolar_evento, tomar_lote, marcar_ok, marcar_fallido, purgar_procesados, estadisticas_cola
+)
 
 webhooks = APIRouter()
+logger = logging.getLogger(__name__)
+
+# Pool de workers que drena la cola durable (tabla webhook_cola)
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "2"))
+WEBHOOK_LOTE = int(os.getenv("WEBHOOK_LOTE", "20"))
+WEBHOOK_POLL = float(os.getenv("WEBHOOK_POLL", "2"))   # segundos entre sondeos si la cola está vacía
+
+_despertar = None      # asyncio.Event: el endpoint avisa que hay algo nuevo
+_workers = []
 
 
 @webhooks.post("/ml")
@@ -19,18 +36,122 @@ async def recibir_webhook_ml(request: Request):
     resource = data.get("resource")
     print(f"🔔 Notificación recibida: {topic} → {resource}")
 
+    # Solo encolamos: el procesamiento (ML + cache + enriquecido) lo hacen los workers
+    if resource and (
+        (topic in ["orders", "orders_v2"] and resource.startswith("/orders/"))
+        or (topic == "items" and resource.startswith("/items/"))
+    ):
+        try:
+            await asyncio.to_thread(encolar_evento, topic, resource)
+            if _despertar is not None:
+                _despertar.set()
+        except Exception as e:
+            print(f"❌ Error encolando {resource}: {e}")
+            # 5xx para que ML reintente la entrega
+            return JSONResponse(status_code=503, content={"status": "error", "detail": "No se pudo encolar"})
+    return {"status": "ok"}
+
+
+async def _procesar_ordenes(eventos: list):
+    """
+    Procesa un lote de eventos de órdenes: una vez por order_id (dedupe por resource),
+    órdenes traídas en paralelo y todos sus ítems resueltos en un multi-get.
+    """
+    por_resource = {}
+    for ev_id, _, resource, _ in eventos:
+        por_resource.setdefault(resource, []).append(ev_id)
+
+    order_ids = [r.split("/")[-1] for r in por_resource]
+    respuestas = await gather_acotado(fetch_api_async(f"/orders/{oid}") for oid in order_ids)
 
-    if topic in ["orders", "orders_v2"] and resource and resource.startswith("/orders/"):
-        order_id = resource.split("/")[-1]
-        db = SessionLocal()
+    ordenes = [od for od in respuestas if not isinstance(od, BaseException)]
+    await precargar_items([p for od in ordenes for p in _pares_items(od)])
+
+    db = SessionLocal()
+    try:
+        for (resource, ids), oid, od in zip(por_resource.items(), order_ids, respuestas):
+            if isinstance(od, BaseException):
+                await asyncio.to_thread(marcar_fallido, ids, repr(od))
+                continue
+            sid = (od.get("shipping") or {}).get("id")
+            if sid:
+                # la orden cambió: /armar y /despachar no deben seguir viendo el estado anterior
+                invalidar_snapshot(sid)
+            try:
+                # 💾 Guardar directo en cache con datos reales
+                await guardar_pedido_en_cache(od, db, oid, propagar_error=True)
+                await asyncio.to_thread(marcar_ok, ids)
+                print(f"✅ Pedido {oid} guardado en caché")
+            except Exception as e:
+                db.rollback()
+                await asyncio.to_thread(marcar_fallido, ids, repr(e))
+    finally:
+        db.close()
+
+
+async def _procesar_items(eventos: list):
+    ok = []
+    for ev_id, _, resource, _ in eventos:
+        item_id = resource.split("/")[-1]
         try:
-            # 🔧 Traer JSON crudo de la orden
-            order_raw = fetch_api(f"/orders/{order_id}")
-            # 💾 Guardar directo en cache con datos reales
-            await guardar_pedido_en_cache(order_raw, db, order_id)
-            print(f"✅ Pedido {order_id} guardado en caché")
+            # ✏️ Cambió una publicación → invalidar su cache de título/imágenes
+            await asyncio.to_thread(invalidar_item, item_id)
+            ok.append(ev_id)
         except Exception as e:
-            print(f"❌ Error procesando pedido {order_id}: {e}")
-        finally:
-            db.close()
-    return {"status": "ok"}
\ No newline at end of file
+            await asyncio.to_thread(marcar_fallido, [ev_id], repr(e))
+    await asyncio.to_thread(marcar_ok, ok)
+
+
+async def _worker(n: int):
+    while True:
+        try:
+            lote = await asyncio.to_thread(tomar_lote, WEBHOOK_LOTE)
+            if not lote:
+                try:
+                    await asyncio.wait_for(_despertar.wait(), WEBHOOK_POLL)
+                except asyncio.TimeoutError:
+                    pass
+                _despertar.clear()
+                continue
+            ordenes = [ev for ev in lote if ev[1] in ("orders", "orders_v2")]
+            items = [ev for ev in lote if ev[1] == "items"]
+            if ordenes:
+                await _procesar_ordenes(ordenes)
+            if items:
+                await _procesar_items(items)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("Worker de webhooks %s: %s", n, e)
+            await asyncio.sleep(WEBHOOK_POLL)
+
+
+async def _purga_periodica():
+    while True:
+        try:
+            n = await asyncio.to_thread(purgar_procesados)
+            if n:
+                logger.info("Cola de webhooks: %s eventos procesados purgados", n)
+        except Exception as e:
+            logger.warning("Purga de la cola de webhooks falló: %s", e)
+        await asyncio.sleep(3600)
+
+
+def iniciar_workers():
+    """Arranca el pool de workers en el event loop de la app (llamar en startup)."""
+    global _despertar
+    _despertar = asyncio.Event()
+    for n in range(max(1, WEBHOOK_WORKERS)):
+        _workers.append(asyncio.create_task(_worker(n)))
+    _workers.append(asyncio.create_task(_purga_periodica()))
+
+
+async def detener_workers():
+    for t in _workers:
+        t.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+
+
+async def metricas_cola() -> dict:
+    return await asyncio.to_thread(estadisticas_cola)
@@ -1,73 +1,254 @@
 from ws.auth import autenticar_desde_json
-from ws.items import obtener_todos_los_items, parsear_items
+from ws.items import obtener_todos_los_items, iterar_items
+from ws.indice_sku import construir_indice
 from database.models import WsItem
-from sqlalchemy.orm import Session, sessionmaker
-from database.init import init_db
-from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
 from dotenv import load_dotenv
 from datetime import datetime
+from pathlib import Path
 import logging
 import os
+import threading
+import time
+try:
+    import fcntl  # lock entre workers de uvicorn (Linux/macOS)
+except ImportError:
+    fcntl = None
 
 # Crear carpeta de logs si no existe
 os.makedirs("logs", exist_ok=True)
 log_file = f"logs/catalogo_{datetime.now().strftime('%Y%m%d')}.log"
 logging.basicConfig(filename=log_file, level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 
-def actualizar_ws_items(db: Session):
+SYNC_CHUNK = int(os.getenv("WS_CATALOGO_SYNC_CHUNK", "1000"))  # filas por commit en el upsert
+
+def _upsert_stmt(dialecto: str, filas: list):
+    """INSERT ... ON CONFLICT (item_id) DO UPDATE nativo de SQLite/Postgres."""
+    if dialecto == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialecto == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        return None
+    stmt = insert(WsItem.__table__).values(filas)
+    return stmt.on_conflict_do_update(
+        index_elements=[WsItem.__table__.c.item_id],
+        set_={
+            "item_code": stmt.excluded.item_code,
+            "item_vendorCode": stmt.excluded.item_vendorCode,
+            "actualizado": stmt.excluded.actualizado,
+        },
+    )
+
+def _escribir_chunk(db: Session, dialecto: str, filas: list, existentes: dict):
+    stmt = _upsert_stmt(dialecto, filas)
+    if stmt is not None:
+        db.execute(stmt)
+    else:
+        # Otros motores: bulk insert/update por separado
+        db.bulk_insert_mappings(WsItem, [f for f in filas if f["item_id"] not in existentes])
+        db.bulk_update_mappings(WsItem, [f for f in filas if f["item_id"] in existentes])
+    db.commit()
+
+def reconstruir_indice_sku(db: Session) -> int:
+    """Arma el índice SKU desde ws_items_cache y lo publica atómicamente."""
+    filas = db.query(WsItem.item_code, WsItem.item_id, WsItem.item_vendorCode).yield_per(5000)
+    n = construir_indice(filas)
+    logging.info(f"Índice de SKUs regenerado: {n} SKUs")
+    return n
+
+def actualizar_ws_items(db: Session) -> dict | None:
+    """
+    Sincroniza ws_items_cache contra el catálogo del WS:
+    carga lo existente en una sola query, compara por contenido y escribe solo
+    filas nuevas o cambiadas con upserts nativos, en commits de a SYNC_CHUNK.
+    Devuelve conteos y tiempos.
+    """
     print("🔄 Iniciando actualización del catálogo desde Web Service...")
+    t0 = time.perf_counter()
     token = autenticar_desde_json()
     xml = obtener_todos_los_items(token)
+    t_descarga = time.perf_counter() - t0
 
-    if not xml or not xml.strip().startswith("<"):
+    if not xml or not xml[:100].lstrip().startswith("<"):
         print("❌ El XML devuelto es inválido o vacío.")
         logging.error("El XML devuelto es inválido o vacío.")
-        return
+        return None
+
+    # 1) Catálogo actual en una pasada: item_id -> (item_code, item_vendorCode)
+    t1 = time.perf_counter()
+    existentes = {
+        item_id: (code, vendor)
+        for item_id, code, vendor in db.query(WsItem.item_id, WsItem.item_code, WsItem.item_vendorCode)
+    }
 
+    # 2) Diff por contenido (si el WS repite un item_id, gana la última fila)
+    cambios = {}
+    vistos = set()
     try:
-        items = parsear_items(xml)
+        for item_id, item_code, item_vendorCode in iterar_items(xml):
+            if not item_id:
+                continue
+            vistos.add(item_id)
+            if existentes.get(item_id) == (item_code, item_vendorCode):
+                cambios.pop(item_id, None)
+                continue
+            cambios[item_id] = (item_code, item_vendorCode)
     except Exception as e:
         print("❌ Error al parsear XML:", e)
         logging.error(f"Error al parsear XML: {e}")
-        return
-
-    print(f"📦 {len(items)} ítems obtenidos. Procesando...")
-
-    nuevos = []
-    actualizados = 0
-
-    for idx, data in enumerate(items):
-        existente = db.get(WsItem, data["item_id"])
-        if existente:
-            existente.item_code = data["item_code"]
-            existente.item_vendorCode = data["item_vendorCode"]
-            existente.actualizado = datetime.utcnow()
-            actualizados += 1
-        else:
-            nuevos.append(WsItem(
-                item_id=data["item_id"],
-                item_code=data["item_code"],
-                item_vendorCode=data["item_vendorCode"]
-            ))
-
-        if idx > 0 and idx % 500 == 0:
-            print(f"🔁 {idx}/{len(items)} procesados...")
-
-    if nuevos:
-        db.bulk_save_objects(nuevos)
-    db.commit()
+        return None
+    t_diff = time.perf_counter() - t1
 
-    print(f"✅ Catálogo actualizado: {len(nuevos)} nuevos, {actualizados} actualizados.")
-    logging.info(f"Catálogo actualizado: {len(nuevos)} nuevos, {actualizados} actualizados.")
+    insertados = sum(1 for i in cambios if i not in existentes)
+    actualizados = len(cambios) - insertados
+    sin_cambios = len(vistos) - len(cambios)
 
-if __name__ == "__main__":
+    # 3) Upsert por chunks (SQLite viejo tiene límite de 999 parámetros por statement)
+    t2 = time.perf_counter()
+    dialecto = db.get_bind().dialect.name
+    chunk = min(SYNC_CHUNK, 200) if dialecto == "sqlite" else SYNC_CHUNK
+    ahora = datetime.utcnow()
+    filas = [
+        {"item_id": i, "item_code": code, "item_vendorCode": vendor, "actualizado": ahora}
+        for i, (code, vendor) in cambios.items()
+    ]
+    try:
+        for n in range(0, len(filas), chunk):
+            _escribir_chunk(db, dialecto, filas[n:n + chunk], existentes)
+            if n and n % (chunk * 10) == 0:
+                print(f"🔁 {n}/{len(filas)} escritos...")
+    except Exception as e:
+        db.rollback()
+        print("❌ Error escribiendo catálogo:", e)
+        logging.error(f"Error escribiendo catálogo: {e}")
+        return None
+    t_escritura = time.perf_counter() - t2
+
+    # 4) Regenerar el índice mmap de SKUs (swap atómico, lo toman todos los workers)
+    t3 = time.perf_counter()
+    try:
+        n_indice = reconstruir_indice_sku(db)
+    except Exception as e:
+        n_indice = None
+        logging.error(f"No se pudo regenerar el índice de SKUs: {e}")
+    t_indice = time.perf_counter() - t3
+
+    resultado = {
+        "insertados": insertados,
+        "actualizados": actualizados,
+        "sin_cambios": sin_cambios,
+        "indice_skus": n_indice,
+        "segundos": {
+            "descarga": round(t_descarga, 2),
+            "diff": round(t_diff, 2),
+            "escritura": round(t_escritura, 2),
+            "indice": round(t_indice, 2),
+            "total": round(time.perf_counter() - t0, 2),
+        },
+    }
+    print(f"✅ Catálogo actualizado: {insertados} nuevos, {actualizados} actualizados, {sin_cambios} sin cambios.")
+    logging.info(f"Catálogo actualizado: {resultado}")
+    return resultado
 
+# Refresh del catálogo en background (pedido por la enriquecida de SKUs cuando hay faltantes)
+REFRESH_COOLDOWN = int(os.getenv("WS_CATALOGO_REFRESH_COOLDOWN", "900"))  # segundos entre refrescos
+REFRESH_LOCK_PATH = Path(os.getenv("WS_CATALOGO_LOCK_PATH",
+                                   Path(__file__).resolve().parent.parent / "ws_catalogo.lock"))
+_refresh_lock = threading.Lock()
+_skus_lock = threading.Lock()   # protege los dos sets (requests + hilo de refresh)
+_ultimo_refresh = 0.0
+_skus_pendientes = set()   # SKUs pedidos desde el último refresh
+_skus_ausentes = set()     # SKUs que siguieron faltando después del último refresh
+SKUS_PLACEHOLDER = {"Sin SKU"}
+
+
+def _refrescar_entre_procesos(db: Session) -> bool:
+    """
+    Corre actualizar_ws_items si ningún otro worker lo está haciendo ni lo hizo en los
+    últimos REFRESH_COOLDOWN segundos (lock no bloqueante sobre REFRESH_LOCK_PATH, que
+    guarda el timestamp del último refresh). Devuelve True si refrescó este proceso.
+    """
+    if fcntl is None:
+        actualizar_ws_items(db)
+        return True
+    REFRESH_LOCK_PATH.parent.mkdir(parents=True, exist_ok=True)
+    with open(REFRESH_LOCK_PATH, "a+") as fh:
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        try:
+            fh.seek(0)
+            try:
+                ultimo = float(fh.read().strip() or 0)
+            except ValueError:
+                ultimo = 0.0
+            if time.time() - ultimo < REFRESH_COOLDOWN:
+                return False
+            actualizar_ws_items(db)
+            fh.truncate(0)
+            fh.write(str(time.time()))
+            return True
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
 
+
+def solicitar_refresh_catalogo(skus=()) -> bool:
+    """
+    Encola un refresh del catálogo WS en un hilo aparte, sin bloquear al request.
+    Uno a la vez y como mucho cada REFRESH_COOLDOWN segundos (también entre workers);
+    devuelve True si lanzó el hilo. SKUs vacíos o placeholder, y los que ya faltaban
+    tras el último refresh, no lo disparan.
+    """
+    global _ultimo_refresh
+    nuevos = {s.strip() for s in skus if s and s.strip() and s.strip() not in SKUS_PLACEHOLDER}
+    with _skus_lock:
+        nuevos -= _skus_ausentes
+        if not nuevos:
+            return False
+        _skus_pendientes.update(nuevos)
+    if time.time() - _ultimo_refresh < REFRESH_COOLDOWN:
+        return False
+    if not _refresh_lock.acquire(blocking=False):
+        return False
+    _ultimo_refresh = time.time()
+
+    def _run():
+        from database.connection import SessionLocal
+        with _skus_lock:
+            pendientes = set(_skus_pendientes)
+            _skus_pendientes.clear()
+        logging.info(f"Refresh de catálogo en background por {len(pendientes)} SKUs faltantes")
+        db = SessionLocal()
+        try:
+            if not _refrescar_entre_procesos(db):
+                logging.info("Refresh de catálogo: otro worker lo está corriendo o lo corrió hace poco")
+            # Aunque lo haya refrescado otro worker, la tabla es compartida: se consulta igual
+            encontrados = {code for (code,) in db.query(WsItem.item_code)
+                                                  .filter(WsItem.item_code.in_(pendientes))}
+            ausentes = pendientes - encontrados
+            with _skus_lock:
+                _skus_ausentes.clear()
+                _skus_ausentes.update(ausentes)
+            if ausentes:
+                logging.info(f"{len(ausentes)} SKUs siguen sin estar en el catálogo WS: "
+                             f"{sorted(ausentes)[:20]}")
+        except Exception as e:
+            logging.error(f"Refresh de catálogo en background falló: {e}")
+        finally:
+            db.close()
+            _refresh_lock.release()
+
+    threading.Thread(target=_run, name="ws-catalogo-refresh", daemon=True).start()
+    return True
+
+if __name__ == "__main__":
     load_dotenv()
 
-    DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///pedidos.db")
-    engine = create_engine(DATABASE_URL)
-    SessionLocal = sessionmaker(bind=engine)
+    # database.connection arma el engine al importarse: va recién acá, después del .env,
+    # para que tome DATABASE_URL y el pool configurado (arriba solo se importan los modelos)
+    from database.connection import SessionLocal
 
     db = SessionLocal()
     try:
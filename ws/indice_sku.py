@@ -0,0 +1,125 @@
+# ws/indice_sku.py
+"""
+Índice SKU → (item_id, item_vendorCode) en un archivo ordenado y memory-mapped.
+
+Lo arma la sincronización del catálogo y lo comparten todos los workers de
+uvicorn sin copiarlo: cada búsqueda es binaria sobre el mmap (O(log n), sin red).
+El archivo se reemplaza atómicamente (os.replace), así que un lector nunca ve
+un índice a medio escribir; al detectar el cambio de inodo se re-mapea.
+
+Formato:
+    b"SKUIDX01" | N (uint32) | N offsets (uint32) | registros
+    registro = sku \\x1f item_id \\x1f item_vendorCode \\n   (utf-8, ordenados por sku)
+"""
+import mmap
+import os
+import struct
+import threading
+from pathlib import Path
+
+MAGIC = b"SKUIDX01"
+SEP = b"\x1f"
+ROOT = Path(__file__).resolve().parent.parent
+INDEX_PATH = Path(os.getenv("WS_SKU_INDEX_PATH", ROOT / "sku_index.bin"))
+
+_lock = threading.Lock()
+_actual = None   # (inodo, mtime_ns, file, mmap, n)
+
+
+def construir_indice(filas, path: Path = INDEX_PATH) -> int:
+    """
+    Escribe el índice a partir de (item_code, item_id, item_vendorCode) y lo
+    publica atómicamente. Si un SKU se repite, queda la última fila. Devuelve N.
+    """
+    registros = {}
+    for code, item_id, vendor in filas:
+        if not code:
+            continue
+        registros[code.encode("utf-8")] = SEP.join([
+            code.encode("utf-8"),
+            (item_id or "").encode("utf-8"),
+            (vendor or "").encode("utf-8"),
+        ]) + b"\n"
+
+    claves = sorted(registros)
+    n = len(claves)
+    base = len(MAGIC) + 4 + 4 * n
+    offsets, pos = [], base
+    for k in claves:
+        offsets.append(pos)
+        pos += len(registros[k])
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + f".{os.getpid()}.tmp")
+    with open(tmp, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<I", n))
+        f.write(struct.pack(f"<{n}I", *offsets))
+        for k in claves:
+            f.write(registros[k])
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return n
+
+
+def _abrir(path: Path):
+    """Devuelve el mmap vigente, re-mapeando si el archivo fue reemplazado."""
+    global _actual
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    actual = _actual
+    if actual and actual[0] == st.st_ino and actual[1] == st.st_mtime_ns:
+        return actual
+    with _lock:
+        actual = _actual
+        if actual and actual[0] == st.st_ino and actual[1] == st.st_mtime_ns:
+            return actual
+        f = open(path, "rb")
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if mm[:len(MAGIC)] != MAGIC:
+            mm.close()
+            f.close()
+            raise ValueError(f"Índice de SKUs inválido: {path}")
+        n = struct.unpack_from("<I", mm, len(MAGIC))[0]
+        # El mmap anterior se suelta por GC (puede haber una búsqueda usándolo todavía)
+        _actual = (st.st_ino, st.st_mtime_ns, f, mm, n)
+        return _actual
+
+
+def _registro(mm, i: int) -> bytes:
+    off = struct.unpack_from("<I", mm, len(MAGIC) + 4 + 4 * i)[0]
+    fin = mm.find(b"\n", off)
+    return mm[off:fin]
+
+
+def indice_disponible(path: Path = INDEX_PATH) -> bool:
+    return Path(path).exists()
+
+
+def buscar_en_indice(sku: str, path: Path = INDEX_PATH):
+    """
+    {"item_id", "item_code", "item_vendorCode"} para el SKU, o None.
+    Lanza FileNotFoundError si todavía no hay índice construido.
+    """
+    actual = _abrir(Path(path))
+    if actual is None:
+        raise FileNotFoundError(f"No existe el índice de SKUs: {path}")
+    mm, n = actual[3], actual[4]
+    clave = sku.encode("utf-8")
+    lo, hi = 0, n
+    while lo < hi:
+        mid = (lo + hi) // 2
+        reg = _registro(mm, mid)
+        k = reg.split(SEP, 1)[0]
+        if k < clave:
+            lo = mid + 1
+        elif k > clave:
+            hi = mid
+        else:
+            code, item_id, vendor = reg.decode("utf-8").split("\x1f")
+            return {"item_id": item_id or None, "item_code": code, "item_vendorCode": vendor or None}
+    return None
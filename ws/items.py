@@ -1,12 +1,16 @@
 import requests
 import xml.etree.ElementTree as ET
+from typing import Iterator
 from ws.auth import autenticar_desde_json
+from ws.indice_sku import buscar_en_indice, indice_disponible
 
 WSDL_URL = "https://ws.globalbluepoint.com/silmarbazar/app_webservices/wsBasicQuery.asmx"
 HEADERS_SOAP = {
     "Content-Type": "text/xml; charset=utf-8",
     "SOAPAction": "http://microsoft.com/webservices/Item_funGetXMLData"
 }
+RESULT_TAG = "{http://microsoft.com/webservices/}Item_funGetXMLDataResult"
+CHUNK_SIZE = 64 * 1024
 
 def obtener_todos_los_items(token: str) -> str:
     body = f"""<?xml version="1.0" encoding="utf-8"?>
@@ -27,47 +31,88 @@ def obtener_todos_los_items(token: str) -> str:
       </soap:Body>
     </soap:Envelope>"""
 
-    result = requests.post(WSDL_URL, data=body.encode("utf-8"), headers=HEADERS_SOAP)
-
-    print("📨 XML crudo recibido:")
-    print(result.text[:1000])  # Primeros 1000 caracteres
+    result = requests.post(WSDL_URL, data=body.encode("utf-8"), headers=HEADERS_SOAP, stream=True)
 
+    # Parseo incremental del sobre SOAP: no guardamos la respuesta cruda ni su árbol
     try:
-        tree = ET.fromstring(result.text)
-        nodo = tree.find(".//{http://microsoft.com/webservices/}Item_funGetXMLDataResult")
-        if nodo is None or not nodo.text:
-            print("❌ Nodo vacío o no encontrado")
-            return ""
-        
-        if "TOKEN Expired" in nodo.text:
-            print("🔁 Token expirado detectado, reautenticando...")
-            
-            new_token = autenticar_desde_json(force_renovar=True)
-            return obtener_todos_los_items(new_token)
-
-        return nodo.text
+        parser = ET.XMLPullParser(events=("end",))
+        texto = None
+        for chunk in result.iter_content(CHUNK_SIZE):
+            parser.feed(chunk)
+            for _, elem in parser.read_events():
+                if elem.tag == RESULT_TAG:
+                    texto = elem.text
+                    elem.clear()
+        parser.close()
     except ET.ParseError as e:
         print("❌ Error parseando el XML:", e)
-        return ""    
-    
+        return ""
+    finally:
+        result.close()
+
+    if not texto:
+        print("❌ Nodo vacío o no encontrado")
+        return ""
+
+    if "TOKEN Expired" in texto[:1000]:
+        print("🔁 Token expirado detectado, reautenticando...")
+
+        new_token = autenticar_desde_json(force_renovar=True)
+        return obtener_todos_los_items(new_token)
+
+    print(f"📨 XML de catálogo recibido ({len(texto)} caracteres)")
+    return texto
+
+
+def iterar_items(xml_texto: str) -> Iterator[tuple]:
+    """
+    Recorre el XML del catálogo de forma incremental y va devolviendo
+    (item_id, item_code, item_vendorCode) por cada <Table>, liberando cada
+    elemento apenas se lee: la memoria no crece con el tamaño del catálogo.
+    """
+    parser = ET.XMLPullParser(events=("start", "end"))
+    root = None
+    for n in range(0, len(xml_texto), CHUNK_SIZE):
+        parser.feed(xml_texto[n:n + CHUNK_SIZE])
+        for event, elem in parser.read_events():
+            if event == "start":
+                if root is None:
+                    root = elem
+                continue
+            if elem.tag == "Table":
+                yield (
+                    elem.findtext("item_id"),
+                    elem.findtext("item_code"),
+                    elem.findtext("item_vendorCode"),
+                )
+                elem.clear()
+                if root is not None:
+                    root.clear()
+    parser.close()
+
 
 def parsear_items(xml_texto: str) -> list[dict]:
-    items_extraidos = []
-    root = ET.fromstring(xml_texto)
-    for item in root.findall("Table"):
-        items_extraidos.append({
-            "item_id": item.findtext("item_id"),
-            "item_code": item.findtext("item_code"),
-            "item_vendorCode": item.findtext("item_vendorCode")
-        })
-    return items_extraidos
+    return [
+        {"item_id": item_id, "item_code": item_code, "item_vendorCode": vendor}
+        for item_id, item_code, vendor in iterar_items(xml_texto)
+    ]
 
 def buscar_item_por_sku(sku: str):
+    # Índice mmap armado por la sync del catálogo: O(log n), sin red
+    if indice_disponible():
+        item = buscar_en_indice(sku)
+        if item:
+            print(f"🎯 Coincidencia para SKU {sku}: {item}")
+        return item
+
+    # Sin índice todavía (primer arranque): bajar el catálogo completo
     token = autenticar_desde_json()
     datos = obtener_todos_los_items(token)
-    items = parsear_items(datos)
-    for item in items:
-        if item["item_code"] == sku:
+    if not datos:
+        return None
+    for item_id, item_code, vendor in iterar_items(datos):
+        if item_code == sku:
+            item = {"item_id": item_id, "item_code": item_code, "item_vendorCode": vendor}
             print(f"🎯 Coincidencia para SKU {sku}: {item}")
             return item
     return None